@@ -5,9 +5,21 @@ import time
 import platform
 import datetime
 import difflib
-import filecmp
 import shutil
-from threading import Thread
+import json
+import hashlib
+import io
+import gzip
+import zlib
+import tempfile
+import traceback
+import bisect
+import itertools
+import types
+import fnmatch
+import codecs
+from collections import OrderedDict, deque
+from threading import Thread, Lock, Condition
 import subprocess
 import sublime
 import sublime_plugin
@@ -22,6 +34,69 @@ else:
 NO_SELECTION = -1
 settings = None
 
+HISTORY_INDEX = '.lh_index.json'
+INDEX_VERSION = 1
+LEDGER_FILE = '.lh_ledger.json'
+LEDGER_LOG = '.lh_ledger.log'
+MANIFEST_FILE = '.lh_manifest.json'
+LEDGER_VERSION = 4
+BLOB_DIR = '.lh_blobs'
+DELTA_DIR = '.lh_deltas'
+RECORD_DIR = '.lh_revs'
+DIFF_DIR = '.lh_diffs'
+SNAPSHOT_DIR = '.lh_snapshots'
+PACK_DIR = '.lh_pack'
+PACK_COMPACT_MIN = 1048576
+DELTA_MAGIC = b'LHD1\n'
+COMPRESSED_SUFFIX = '.lhz'
+SEARCH_DIR = '.lh_search'
+SEARCH_SHARDS = 64
+SNIFF_SIZE = 8192
+TEXT_CONTROL_BYTES = bytearray(b'\t\n\r\f\b\x1b')
+TOKEN_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]{2,63}')
+
+# Sublime Text encoding names -> python codecs, for writing the buffer as it would be saved
+BUFFER_ENCODINGS = {
+    'Undefined': 'utf-8',
+    'UTF-8': 'utf-8',
+    'UTF-8 with BOM': 'utf-8-sig',
+    'UTF-16 LE': 'utf-16-le',
+    'UTF-16 BE': 'utf-16-be',
+    'Western (Windows 1252)': 'cp1252',
+    'Western (ISO 8859-1)': 'latin-1',
+}
+BUFFER_LINE_ENDINGS = {'Unix': '\n', 'Windows': '\r\n', 'CR': '\r'}
+index_lock = Lock()
+index_cache = {}
+fingerprint_lock = Lock()
+fingerprints = OrderedDict()
+ledger_lock = Lock()
+ledger_cache = {}
+ledger_totals = {}
+diff_totals = {}
+ledger_log_lines = {}
+search_lock = Lock()
+search_indexes = {}
+blame_lock = Lock()
+blame_cache = OrderedDict()
+timeline_lock = Lock()
+timeline_cache = OrderedDict()
+history_filters = {'include': None, 'exclude': None, 'size_limits': {}}
+perf_lock = Lock()
+perf_stats = OrderedDict()
+pack_lock = Lock()
+revision_packs = {}
+cleanup_jobs = set()
+manifest_lock = Lock()
+manifest_cache = {}
+
+RETENTION_INTERVALS = (
+    ("Older than one year", "year", 31536000),
+    ("Older than six months", "months6", 15811200),
+    ("Older than one month", "month", 2635200),
+    ("Older than one week", "week", 604800),
+)
+
 def status_msg(msg):
     sublime.status_message('Local History: ' + msg)
 
@@ -33,15 +108,65 @@ def readable_file_size(size):
         order = int(log2(size) / 10) if size else 0
     return '{:.4g} {}'.format(size / (1 << (order * 10)), suffixes[order])
 
+class timed(object):
+    '''Times a stage of a hot path into perf_stats, with timed('save.read') as t: ... t.bytes = n'''
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        record_timing(self.stage, time.time() - self.start, self.bytes)
+
+def timed_function(stage):
+    '''Decorator timing every call of a function as stage'''
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def record_timing(stage, seconds, size=0):
+    '''Count a call of stage, keeping the last 1000 durations for percentiles.
+    Also appended to .lh_perf.jsonl in the history root when "performance_log" is set.'''
+    with perf_lock:
+        if stage not in perf_stats:
+            perf_stats[stage] = {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'recent': deque(maxlen=1000)}
+        stats = perf_stats[stage]
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['bytes'] += size
+        stats['recent'].append(seconds)
+    if settings.get('performance_log', False):
+        line = json.dumps({'stage': stage, 'time': time.time(), 'seconds': seconds, 'bytes': size})
+        make_dirs(get_history_root())
+        with perf_lock:
+            with open(os.path.join(get_history_root(), '.lh_perf.jsonl'), 'a') as f:
+                f.write(line + '\n')
+
+def performance_report():
+    '''Table of the stages timed since the plugin was loaded'''
+    lines = ['{:<20} {:>8} {:>9} {:>9} {:>10} {:>12}\n'.format('stage', 'calls', 'p50 ms', 'p95 ms', 'total s', 'bytes')]
+    with perf_lock:
+        for stage, stats in sorted(perf_stats.items()):
+            recent = sorted(stats['recent'])
+            p50, p95 = (recent[min(len(recent) - 1, int(len(recent) * p))] * 1000 for p in (0.5, 0.95))
+            lines.append('{:<20} {:>8} {:>9.2f} {:>9.2f} {:>10.2f} {:>12}\n'.format(
+                stage, stats['calls'], p50, p95, stats['seconds'], readable_file_size(stats['bytes'])))
+    return ''.join(lines)
+
 def get_history_root():
     path_default_not_portable = os.path.join(os.path.abspath(os.path.expanduser('~')), '.sublime', 'Local History')
     path_not_portable = settings.get('history_path', path_default_not_portable)
     return os.path.join(os.path.dirname(sublime.packages_path()), '.sublime', 'Local History') if settings.get('portable', True) else path_not_portable
 
-def get_history_subdir(file_path):
-    history_root = get_history_root()
-
-    file_dir = os.path.dirname(file_path)
+def source_dir_key(file_dir):
+    '''Relative form of a source directory, where the "mirror" layout keeps its history'''
     if platform.system() == 'Windows':
         if file_dir.find(os.sep) == 0:
             file_dir = file_dir[2:]
@@ -49,17 +174,1359 @@ def get_history_subdir(file_path):
             file_dir = file_dir.replace(':', '', 1)
     else:
         file_dir = file_dir[1:]
+    return file_dir
+
+def history_dir_for(key):
+    '''History directory of the source directory with key in the "history_layout" setting.
+    "hashed" puts it two levels deep, named after the hash of key, and records key in the manifest.'''
+    history_root = get_history_root()
+    if settings.get('history_layout', 'mirror') != 'hashed':
+        return os.path.join(history_root, key)
+    digest = hashlib.sha1(key if isinstance(key, bytes) else key.encode('utf-8')).hexdigest()
+    rel_dir = os.path.join(digest[:2], digest[2:18])
+    remember_source(rel_dir, key)
+    return os.path.join(history_root, rel_dir)
 
-    return os.path.join(history_root, file_dir)
+def get_history_subdir(file_path):
+    return history_dir_for(source_dir_key(os.path.dirname(file_path)))
+
+def load_manifest(history_root):
+    '''Source keys of the hashed history directories of history_root. Callers hold manifest_lock.'''
+    if history_root not in manifest_cache:
+        try:
+            with open(os.path.join(history_root, MANIFEST_FILE), 'r') as f:
+                manifest_cache[history_root] = json.load(f)
+        except (IOError, OSError, ValueError):
+            manifest_cache[history_root] = {}
+    return manifest_cache[history_root]
+
+def write_manifest(history_root, manifest):
+    make_dirs(history_root)
+    with open(os.path.join(history_root, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+
+def remember_source(rel_dir, key):
+    history_root = get_history_root()
+    with manifest_lock:
+        manifest = load_manifest(history_root)
+        if manifest.get(rel_dir) != key:
+            manifest[rel_dir] = key
+            write_manifest(history_root, manifest)
+
+def forget_source(rel_dir):
+    history_root = get_history_root()
+    with manifest_lock:
+        manifest = load_manifest(history_root)
+        if manifest.pop(rel_dir, None) is not None:
+            write_manifest(history_root, manifest)
+
+def history_dir_key(history_dir):
+    '''Source key of a history directory in either layout'''
+    rel_dir = os.path.relpath(history_dir, get_history_root())
+    with manifest_lock:
+        return load_manifest(get_history_root()).get(rel_dir, rel_dir)
+
+def ledger_entries_under(ledger, folder_key):
+    '''(ledger key, source key) of the history directories of the source folder with folder_key and
+    its sub folders, through the manifest so both layouts are found'''
+    with manifest_lock:
+        manifest = dict(load_manifest(get_history_root()))
+    entries = []
+    for key in ledger:
+        source = manifest.get(key, key)
+        if folder_key == os.curdir or source == folder_key or source.startswith(folder_key + os.sep):
+            entries.append((key, source))
+    return entries
+
+def timestamp_pattern():
+    '''Regex matching the timestamps written with "format_timestamp"'''
+    directives = {'Y': r'\d{4}', 'y': r'\d{2}', 'm': r'\d{2}', 'd': r'\d{2}', 'H': r'\d{2}',
+                  'M': r'\d{2}', 'S': r'\d{2}', 'j': r'\d{3}', 'f': r'\d+', '%': '%'}
+    parts = re.split(r'(%.)', settings.get('format_timestamp', '%Y%m%d%H%M%S'))
+    return ''.join(directives.get(p[1], '.+?') if len(p) == 2 and p[0] == '%' else re.escape(p) for p in parts)
+
+def history_source_name(rev_name):
+    '''Name of the file a history revision belongs to, None if it is not a revision.
+    Revisions saved under an earlier "format_timestamp" are matched by the "-" before their timestamp,
+    preferably one followed by a digit.'''
+    splits = (os.path.splitext(rev_name), (rev_name, ''))
+    for root, ext in splits:
+        if ' # ' in root:
+            return root.split(' # ', 1)[0] + ext
+    for pattern in (r'(.+)-' + timestamp_pattern() + '$', r'(.+?)-\d', r'(.+?)-.'):
+        for root, ext in splits:
+            m = re.match(pattern, root)
+            if m:
+                return m.group(1) + ext
+    return None
+
+def sniff_content(prefix):
+    '''("binary", None) or ("text", codec) for content starting with prefix, from byte order marks,
+    control bytes and whether it is valid UTF-8. Other text falls back to the "fallback_encoding" preference.'''
+    for bom, codec in ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')):
+        if prefix.startswith(bom):
+            return 'text', codec
+    data = bytearray(prefix)
+    if 0 in data or sum(1 for b in data if b < 32 and b not in TEXT_CONTROL_BYTES) * 10 > len(data):
+        return 'binary', None
+    try:
+        # the prefix may end inside a character
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, False)
+        return 'text', 'utf-8'
+    except UnicodeDecodeError:
+        fallback = sublime.load_settings('Preferences.sublime-settings').get('fallback_encoding')
+        return 'text', BUFFER_ENCODINGS.get(fallback, 'cp1252')
+
+def decode_lines(content):
+    '''Lines of text content decoded in its sniffed encoding with universal newlines, None for binary content'''
+    kind, codec = sniff_content(content[:SNIFF_SIZE])
+    if kind == 'binary':
+        return None
+    if PY2:
+        return content.decode(codec, 'replace').encode('utf-8').splitlines(True)
+    with io.TextIOWrapper(io.BytesIO(content), encoding=codec, errors='replace') as f:
+        return f.readlines()
+
+def binary_summary(f1, f2, from_content, to_content):
+    return "\n--- {}\n+++ {}\n\nBinary files differ.\nsize: {} -> {} bytes\nsha1: {} -> {}\n\n\n".format(
+        f1, f2, len(from_content), len(to_content),
+        hashlib.sha1(from_content).hexdigest(), hashlib.sha1(to_content).hexdigest())
+
+def file_digest(path):
+    size, sha1 = 0, hashlib.sha1()
+    with open_payload(path) as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            size += len(chunk)
+            sha1.update(chunk)
+    return size, sha1.hexdigest()
+
+def open_payload(path):
+    '''Stored revision content, decompressed on the fly if it was written compressed'''
+    if not os.path.exists(path) and os.path.exists(path + COMPRESSED_SUFFIX):
+        return gzip.GzipFile(path + COMPRESSED_SUFFIX, 'rb')
+    return io.open(path, 'rb')
+
+def write_payload(path, content):
+    '''Write stored revision content, gzip compressed when "history_compression" is set.
+    Returns the number of bytes written to disk.'''
+    remove_payload(path)
+    if settings.get('history_compression', False):
+        path += COMPRESSED_SUFFIX
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        if path.endswith(COMPRESSED_SUFFIX):
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as gz:
+                gz.write(content)
+        else:
+            f.write(content)
+        stored = f.tell()
+    os.rename(tmp_path, path)
+    return stored
+
+def payload_size(path):
+    for p in (path, path + COMPRESSED_SUFFIX):
+        if os.path.isfile(p):
+            return os.path.getsize(p)
+    return 0
+
+def remove_payload(path):
+    for p in (path, path + COMPRESSED_SUFFIX):
+        if os.path.isfile(p):
+            os.remove(p)
+
+def make_dirs(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+def blob_path(history_dir, digest):
+    return os.path.join(history_dir, BLOB_DIR, digest)
+
+def delta_path(history_dir, rev_name):
+    return os.path.join(history_dir, DELTA_DIR, rev_name)
+
+def record_path(history_dir, rev_name):
+    return os.path.join(history_dir, RECORD_DIR, rev_name + '.json')
+
+def diff_path(history_dir, rev_name):
+    return os.path.join(history_dir, DIFF_DIR, rev_name + '.diff')
+
+def write_revision_record(history_dir, file_name, record):
+    rec_path = record_path(history_dir, record['name'])
+    make_dirs(os.path.dirname(rec_path))
+    with open(rec_path, 'w') as f:
+        json.dump(dict(record, file=file_name), f)
+
+def make_delta(base, content):
+    '''Line delta rebuilding content from base: "C i j" copies base lines i to j, "I n" inserts n bytes'''
+    base_lines = base.splitlines(True)
+    lines = content.splitlines(True)
+
+    # most edits touch a small part of the file, keep the matcher off the common head and tail
+    prefix = 0
+    limit = min(len(base_lines), len(lines))
+    while prefix < limit and base_lines[prefix] == lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and base_lines[-1 - suffix] == lines[-1 - suffix]:
+        suffix += 1
+
+    ops = [DELTA_MAGIC]
+    if prefix:
+        ops.append(('C 0 %d\n' % prefix).encode('ascii'))
+    matcher = difflib.SequenceMatcher(None, base_lines[prefix:len(base_lines) - suffix],
+                                      lines[prefix:len(lines) - suffix])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(('C %d %d\n' % (prefix + i1, prefix + i2)).encode('ascii'))
+        elif j2 > j1:
+            inserted = b''.join(lines[prefix + j1:prefix + j2])
+            ops.append(('I %d\n' % len(inserted)).encode('ascii'))
+            ops.append(inserted)
+    if suffix:
+        ops.append(('C %d %d\n' % (len(base_lines) - suffix, len(base_lines))).encode('ascii'))
+    return b''.join(ops)
+
+def apply_delta(base, delta):
+    base_lines = base.splitlines(True)
+    out = []
+    pos = len(DELTA_MAGIC)
+    while pos < len(delta):
+        end = delta.index(b'\n', pos)
+        op = delta[pos:end].split()
+        pos = end + 1
+        if op[0] == b'C':
+            out.extend(base_lines[int(op[1]):int(op[2])])
+        else:
+            size = int(op[1])
+            out.append(delta[pos:pos + size])
+            pos += size
+    return b''.join(out)
+
+def revision_map(index):
+    '''Revision name -> (file name, record) for all revisions of an index'''
+    return dict((r['name'], (file_name, r)) for file_name, revisions in index['files'].items() for r in revisions)
+
+class RevisionStorage(object):
+    '''Where the content of revisions is kept. Records name their storage in "storage", absent for plain copies,
+    so revisions written under different "history_storage" settings are read and deleted side by side.
+    Callers hold index_lock.'''
+    kind = None
+
+    def write(self, history_dir, index, file_name, record, content):
+        '''Store the content of a new revision and set the storage fields of its record'''
+        raise NotImplementedError
+
+    def open(self, history_dir, rev_map, record):
+        '''Binary file object with the content of a revision'''
+        raise NotImplementedError
+
+    def read(self, history_dir, rev_map, record):
+        with self.open(history_dir, rev_map, record) as f:
+            return f.read()
+
+    def remove(self, history_dir, index, dropped):
+        '''Delete the content of the (file name, record) pairs dropped, still listed in index'''
+        raise NotImplementedError
+
+    def records(self, history_dir, known):
+        '''(file name, record) of the revisions of history_dir kept here, to rebuild a lost index.
+        known maps revision names to the (file name, record) pairs of the index being replaced.'''
+        return []
+
+    def listed(self, history_dir):
+        '''records() without reading any content, the hashes may be missing'''
+        return self.records(history_dir, {})
+
+class CopyStorage(RevisionStorage):
+    '''A full file per revision, named after the revision'''
+
+    def write(self, history_dir, index, file_name, record, content):
+        record['stored'] = write_payload(os.path.join(history_dir, record['name']), content)
+
+    def open(self, history_dir, rev_map, record):
+        return open_payload(os.path.join(history_dir, record['name']))
+
+    def remove(self, history_dir, index, dropped):
+        for file_name, record in dropped:
+            remove_payload(os.path.join(history_dir, record['name']))
+
+    def records(self, history_dir, known):
+        for source, listed in self.listed(history_dir):
+            record = known.get(listed['name'], (None, {}))[1]
+            # revisions never change, an indexed one is only read again if its size on disk differs
+            if record.get('storage') is None and record.get('stored') == listed['stored'] and 'hash' in record:
+                yield source, dict(record)
+                continue
+            listed['size'], listed['hash'] = file_digest(os.path.join(history_dir, listed['name']))
+            yield source, listed
+
+    def listed(self, history_dir):
+        '''Revision files with their size on disk as size, compressed ones are not opened'''
+        for name in copy_revision_names(history_dir):
+            path = os.path.join(history_dir, name)
+            stored = payload_size(path)
+            mtime = max(os.path.getmtime(p) for p in (path, path + COMPRESSED_SUFFIX) if os.path.isfile(p))
+            yield history_source_name(name), {'name': name, 'time': mtime, 'size': stored, 'stored': stored}
+
+class RecordedStorage(RevisionStorage):
+    '''Storage whose revisions also have a record file in .lh_revs, the content lives elsewhere'''
+
+    def records(self, history_dir, known):
+        records_dir = os.path.join(history_dir, RECORD_DIR)
+        if not os.path.isdir(records_dir):
+            return
+        for name in os.listdir(records_dir):
+            try:
+                with open(os.path.join(records_dir, name), 'r') as f:
+                    record = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if record.get('storage') == self.kind:
+                yield record.pop('file'), record
+
+class BlobStorage(RecordedStorage):
+    '''Identical contents share one blob named after their hash'''
+    kind = 'blob'
+
+    def write(self, history_dir, index, file_name, record, content):
+        blob = blob_path(history_dir, record['hash'])
+        record['stored'] = payload_size(blob)
+        if not record['stored']:
+            make_dirs(os.path.dirname(blob))
+            record['stored'] = write_payload(blob, content)
+        record['storage'] = self.kind
+        write_revision_record(history_dir, file_name, record)
+
+    def open(self, history_dir, rev_map, record):
+        return open_payload(blob_path(history_dir, record['hash']))
+
+    def remove(self, history_dir, index, dropped):
+        names = set(record['name'] for file_name, record in dropped)
+        for name in names:
+            remove_payload(record_path(history_dir, name))
+        # blobs are shared, only delete the ones no other revision points to
+        used = set(r['hash'] for revisions in index['files'].values() for r in revisions
+                   if r.get('storage') == self.kind and r['name'] not in names)
+        for digest in set(record['hash'] for file_name, record in dropped) - used:
+            remove_payload(blob_path(history_dir, digest))
+
+class DeltaStorage(RecordedStorage):
+    '''Line deltas against the previous revision, with a keyframe once the chain is "delta_chain_length" long'''
+    kind = 'delta'
+
+    def write(self, history_dir, index, file_name, record, content):
+        record.update(storage=self.kind, base=None, depth=0)
+        payload = content
+        revisions = index['files'].get(file_name, [])
+        head = revisions[0] if revisions else None
+        if head and head.get('storage') == self.kind and head['depth'] + 1 < settings.get('delta_chain_length', 16):
+            delta = make_delta(self.read(history_dir, revision_map(index), head), content)
+            if len(delta) < len(content):
+                record.update(base=head['name'], depth=head['depth'] + 1)
+                payload = delta
+        make_dirs(os.path.join(history_dir, DELTA_DIR))
+        record['stored'] = write_payload(delta_path(history_dir, record['name']), payload)
+        write_revision_record(history_dir, file_name, record)
+
+    def read(self, history_dir, rev_map, record):
+        '''Content of a revision, following its delta chain back to the keyframe'''
+        chain = []
+        while record.get('base'):
+            chain.append(record)
+            record = rev_map[record['base']][1]
+        with open_payload(delta_path(history_dir, record['name'])) as f:
+            content = f.read()
+        for r in reversed(chain):
+            with open_payload(delta_path(history_dir, r['name'])) as f:
+                content = apply_delta(content, f.read())
+        return content
+
+    def open(self, history_dir, rev_map, record):
+        return io.BytesIO(self.read(history_dir, rev_map, record))
+
+    def remove(self, history_dir, index, dropped):
+        rev_map = revision_map(index)
+        names = set(record['name'] for file_name, record in dropped)
+        # deltas built on a dropped revision are turned into keyframes while their base still exists
+        for file_name, record in rev_map.values():
+            if record.get('base') in names and record['name'] not in names:
+                content = self.read(history_dir, rev_map, record)
+                stored = write_payload(delta_path(history_dir, record['name']), content)
+                record.update(base=None, depth=0, stored=stored)
+                write_revision_record(history_dir, file_name, record)
+        for name in names:
+            remove_payload(record_path(history_dir, name))
+            remove_payload(delta_path(history_dir, name))
+
+class RevisionPack(object):
+    '''Append-only pack of all revisions under a history root, so the history is a few files instead of one per revision.
+    <generation>.pack holds the contents, one copy per hash, zlib compressed with "history_compression".
+    <generation>.idx is a log of JSON lines replayed on load: "blob" entries with the offset of a content,
+    "rev" entries with the record of a revision, by the source key of its history directory, and "drop" entries.
+    Dropped revisions leave their contents behind until compact() copies the live ones into the next generation.
+    The files are reloaded when they change behind its back, so contents are never deduplicated against bytes
+    that are gone.'''
+
+    def __init__(self, history_root):
+        self.dir = os.path.join(history_root, PACK_DIR)
+        self.lock = Lock()
+        self.load()
+
+    def path(self, generation, ext):
+        return os.path.join(self.dir, '%08d%s' % (generation, ext))
+
+    def identity(self):
+        '''(inode, size) of the pack and index files of the current generation, None for a missing one'''
+        stats = []
+        for ext in ('.pack', '.idx'):
+            try:
+                st = os.stat(self.path(self.generation, ext))
+                stats.append((st.st_ino, st.st_size))
+            except OSError:
+                stats.append(None)
+        return tuple(stats)
+
+    def refresh(self):
+        if self.identity() != self.seen:
+            self.load()
+
+    def load(self):
+        self.generation = 0
+        self.blobs = {}
+        self.revs = {}
+        self.refs = {}
+        self.size = 0
+        self.seen = self.identity()
+        if not os.path.isdir(self.dir):
+            return
+        generations = sorted(int(name[:-4]) for name in os.listdir(self.dir)
+                             if name.endswith('.idx') and name[:-4].isdigit())
+        if not generations:
+            return
+        self.generation = generations[-1]
+        with open(self.path(self.generation, '.idx'), 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last entry of a write that did not complete
+                    continue
+                self.replay(entry)
+        self.size = payload_size(self.path(self.generation, '.pack'))
+        # contents cut off or deleted with the pack file have to be written again
+        for digest, (offset, length, compressed) in list(self.blobs.items()):
+            if offset + length > self.size:
+                del self.blobs[digest]
+        # a compaction interrupted after writing the next generation, or before removing the previous one
+        for name in os.listdir(self.dir):
+            if not name.startswith('%08d.' % self.generation):
+                remove_file(os.path.join(self.dir, name))
+        self.seen = self.identity()
+
+    def replay(self, entry):
+        if 'blob' in entry:
+            self.blobs[entry['blob']] = entry['offset'], entry['length'], entry.get('zlib', False)
+        elif 'rev' in entry:
+            revs = self.revs.setdefault(entry['dir'], {})
+            if entry['rev'] in revs:
+                self.unref(revs[entry['rev']][1]['hash'])
+            revs[entry['rev']] = entry['file'], entry['record']
+            self.refs[entry['record']['hash']] = self.refs.get(entry['record']['hash'], 0) + 1
+        elif 'drop' in entry:
+            revs = self.revs.get(entry['dir'], {})
+            if entry['drop'] in revs:
+                self.unref(revs.pop(entry['drop'])[1]['hash'])
+            if not revs:
+                self.revs.pop(entry['dir'], None)
+
+    def unref(self, digest):
+        self.refs[digest] -= 1
+        if not self.refs[digest]:
+            del self.refs[digest]
+
+    def log(self, entries):
+        make_dirs(self.dir)
+        with open(self.path(self.generation, '.idx'), 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        for entry in entries:
+            self.replay(entry)
+        self.seen = self.identity()
+
+    def add(self, key, file_name, record, content):
+        '''Append the content of a revision unless the pack has it already, returns its size in the pack'''
+        with self.lock:
+            self.refresh()
+            entries = []
+            digest = record['hash']
+            if digest in self.blobs:
+                record['stored'] = self.blobs[digest][1]
+            else:
+                compress = settings.get('history_compression', False)
+                payload = zlib.compress(content, 6) if compress else content
+                make_dirs(self.dir)
+                with open(self.path(self.generation, '.pack'), 'ab') as f:
+                    f.seek(0, os.SEEK_END)
+                    offset = f.tell()
+                    f.write(payload)
+                self.size = offset + len(payload)
+                record['stored'] = len(payload)
+                entries.append({'blob': digest, 'offset': offset, 'length': len(payload), 'zlib': compress})
+            entries.append({'rev': record['name'], 'dir': key, 'file': file_name, 'record': dict(record)})
+            self.log(entries)
+            return record['stored']
+
+    def read(self, digest):
+        with self.lock:
+            self.refresh()
+            if digest not in self.blobs:
+                raise IOError('content %s is not in the history pack' % digest)
+            offset, length, compressed = self.blobs[digest]
+            with open(self.path(self.generation, '.pack'), 'rb') as f:
+                f.seek(offset)
+                payload = f.read(length)
+        return zlib.decompress(payload) if compressed else payload
+
+    def drop(self, key, rev_names):
+        with self.lock:
+            self.refresh()
+            revs = self.revs.get(key, {})
+            entries = [{'drop': name, 'dir': key} for name in rev_names if name in revs]
+            if entries:
+                self.log(entries)
+
+    def lookup(self, key, name):
+        with self.lock:
+            entry = self.revs.get(key, {}).get(name)
+            return dict(entry[1]) if entry else None
+
+    def cached_diffs(self, key):
+        '''Name -> bytes in the pack of the cached diffs of a history directory'''
+        with self.lock:
+            self.refresh()
+            return dict((name, record['stored']) for name, (file_name, record) in self.revs.get(key, {}).items()
+                        if not file_name)
+
+    def records(self, key):
+        '''(file name, record) of the revisions of a history directory, cached diffs have no file name'''
+        with self.lock:
+            return [(file_name, dict(record)) for file_name, record in self.revs.get(key, {}).values() if file_name]
+
+    def garbage(self):
+        '''Bytes of the pack no revision points to anymore'''
+        with self.lock:
+            return self.size - sum(self.blobs[digest][1] for digest in self.refs if digest in self.blobs)
+
+    def compact(self):
+        '''Copy the contents and records still in use into the next generation and delete the current one.
+        Records whose content was lost with a truncated or replaced pack are left out.
+        Returns the number of bytes reclaimed and the (key, file name, record) of the records left out.'''
+        with self.lock:
+            self.refresh()
+            if not self.size:
+                return 0, []
+            before = self.size
+            generation = self.generation + 1
+            blobs = {}
+            lost = []
+            with open(self.path(self.generation, '.pack'), 'rb') as src:
+                with open(self.path(generation, '.pack'), 'wb') as dst:
+                    for digest in sorted((d for d in self.refs if d in self.blobs), key=lambda d: self.blobs[d][0]):
+                        offset, length, compressed = self.blobs[digest]
+                        src.seek(offset)
+                        blobs[digest] = dst.tell(), length, compressed
+                        dst.write(src.read(length))
+            tmp_path = self.path(generation, '.idx.tmp')
+            with open(tmp_path, 'w') as f:
+                for digest, (offset, length, compressed) in blobs.items():
+                    f.write(json.dumps({'blob': digest, 'offset': offset, 'length': length, 'zlib': compressed}) + '\n')
+                for key, revs in self.revs.items():
+                    for name, (file_name, record) in revs.items():
+                        if record['hash'] not in blobs:
+                            lost.append((key, file_name, record))
+                            continue
+                        f.write(json.dumps({'rev': name, 'dir': key, 'file': file_name, 'record': record}) + '\n')
+            # the new index appearing is what switches generations, an interrupted compaction keeps the old one
+            os.rename(tmp_path, self.path(generation, '.idx'))
+            remove_file(self.path(self.generation, '.idx'))
+            remove_file(self.path(self.generation, '.pack'))
+            self.load()
+            return before - self.size, lost
+
+def revision_pack(history_root=None):
+    history_root = history_root or get_history_root()
+    with pack_lock:
+        if history_root not in revision_packs:
+            revision_packs[history_root] = RevisionPack(history_root)
+        return revision_packs[history_root]
+
+class PackStorage(RevisionStorage):
+    '''Revisions and their records in the RevisionPack of the history root, history directories only keep their index'''
+    kind = 'pack'
+
+    def write(self, history_dir, index, file_name, record, content):
+        record['storage'] = self.kind
+        revision_pack().add(history_dir_key(history_dir), file_name, record, content)
+
+    def open(self, history_dir, rev_map, record):
+        return io.BytesIO(revision_pack().read(record['hash']))
+
+    def remove(self, history_dir, index, dropped):
+        revision_pack().drop(history_dir_key(history_dir), [record['name'] for file_name, record in dropped])
+
+    def records(self, history_dir, known):
+        return revision_pack().records(history_dir_key(history_dir))
+
+revision_storages = {None: CopyStorage(), 'blob': BlobStorage(), 'delta': DeltaStorage(), 'pack': PackStorage()}
+# "history_storage" setting -> storage of the revisions it writes
+STORAGE_SETTINGS = {'copy': None, 'dedup': 'blob', 'delta': 'delta', 'pack': 'pack'}
+
+def revision_storage(record):
+    return revision_storages[record.get('storage')]
+
+def compact_revision_pack(min_garbage=0):
+    '''Rewrite the pack of the history root without the contents of deleted revisions,
+    when at least min_garbage bytes and a quarter of the pack would be reclaimed'''
+    history_root = get_history_root()
+    if not os.path.isdir(os.path.join(history_root, PACK_DIR)):
+        return 0
+    pack = revision_pack(history_root)
+    garbage = pack.garbage()
+    if not garbage or min_garbage and (garbage < min_garbage or garbage * 4 < pack.size):
+        return 0
+    with timed('compact') as t:
+        t.bytes, lost = pack.compact()
+    # the history directories still list the revisions that were lost, and the ledger the cached diffs
+    for key, file_name, record in lost:
+        history_dir = history_dir_for(key)
+        if file_name:
+            remove_history_revisions(history_dir, [record['name']])
+        else:
+            account_cached_diffs(history_dir, -record['stored'])
+    lost = [record for key, file_name, record in lost if file_name]
+    if lost:
+        status_msg('%d revisions were no longer in the history pack, dropped them.' % len(lost))
+    return t.bytes
+
+def storage_kind(record):
+    '''Storage "history_storage" selects for a new revision. Binary revisions are stored as blobs
+    deduplicated by hash unless they go to the pack, line deltas do not suit them.'''
+    kind = STORAGE_SETTINGS.get(settings.get('history_storage', 'copy'))
+    if record.get('binary') and kind != 'pack':
+        kind = 'blob'
+    return kind
+
+def store_revision(history_dir, index, file_name, record, content):
+    '''Write the content of a new revision with the storage selected by "history_storage"'''
+    revision_storages[storage_kind(record)].write(history_dir, index, file_name, record, content)
+
+def convert_history_dir(history_dir):
+    '''Store the revisions of a history directory kept in another storage than "history_storage" selects,
+    oldest first so deltas are built in order. Returns the number of revisions moved, callers hold index_lock.'''
+    index = read_history_index(history_dir)
+    rev_map = revision_map(index)
+    converted = {'version': INDEX_VERSION, 'files': {}}
+    dropped = {}
+    for file_name, revisions in index['files'].items():
+        for r in reversed(revisions):
+            kind = storage_kind(r)
+            record = r
+            if r.get('storage') != kind:
+                content = revision_storage(r).read(history_dir, rev_map, r)
+                dropped.setdefault(r.get('storage'), []).append((file_name, r))
+                record = dict((k, v) for k, v in r.items() if k not in ('storage', 'stored', 'base', 'depth'))
+                revision_storages[kind].write(history_dir, converted, file_name, record, content)
+            converted['files'].setdefault(file_name, []).insert(0, record)
+    for kind, revisions in dropped.items():
+        revision_storages[kind].remove(history_dir, index, revisions)
+        # their diffs are cached again next to the new storage
+        remove_cached_diffs(history_dir, [record['name'] for file_name, record in revisions])
+    for name in (BLOB_DIR, DELTA_DIR, RECORD_DIR):
+        try:
+            os.rmdir(os.path.join(history_dir, name))
+        except OSError:
+            pass
+    if dropped:
+        write_history_index(history_dir, converted)
+    return sum(len(revisions) for revisions in dropped.values())
+
+def convert_history_storage():
+    '''Move the revisions of every history directory to the storage "history_storage" selects, on the worker'''
+    history_root = get_history_root()
+    converted = 0
+    for n, key in enumerate(sorted(read_ledger(history_root))):
+        with index_lock:
+            converted += convert_history_dir(os.path.normpath(os.path.join(history_root, key)))
+        if n % 100 == 99:
+            status_msg('converting history, %d folders done.' % (n + 1))
+    compact_revision_pack()
+    status_msg('moved %d revisions to the "%s" storage.' % (converted, settings.get('history_storage', 'copy')))
+
+def drop_revisions(history_dir, index, rev_names):
+    '''Delete revisions from storage and index, callers hold index_lock'''
+    rev_map = revision_map(index)
+    dropped = {}
+    for name in rev_names:
+        if name in rev_map:
+            dropped.setdefault(rev_map[name][1].get('storage'), []).append(rev_map[name])
+    for kind, revisions in dropped.items():
+        revision_storages[kind].remove(history_dir, index, revisions)
+
+    diffs = []
+    for file_name, revisions in list(index['files'].items()):
+        # cached diffs of dropped revisions, and of the revisions they were the predecessor of
+        for newer, older in zip([None] + revisions, revisions):
+            if older['name'] in rev_names:
+                diffs.append(older['name'])
+                if newer:
+                    diffs.append(newer['name'])
+        revisions = [r for r in revisions if r['name'] not in rev_names]
+        if revisions:
+            index['files'][file_name] = revisions
+        else:
+            del index['files'][file_name]
+    remove_cached_diffs(history_dir, diffs)
+
+def read_cached_diff(history_dir, rev_name):
+    '''Cached diff of a revision against its predecessor, from the pack with "history_storage": "pack"'''
+    if settings.get('history_storage', 'copy') == 'pack':
+        pack = revision_pack()
+        record = pack.lookup(history_dir_key(history_dir), rev_name + '.diff')
+        if not record:
+            raise IOError('no cached diff of ' + rev_name)
+        return pack.read(record['hash'])
+    with open_payload(diff_path(history_dir, rev_name)) as f:
+        return f.read()
+
+def write_cached_diff(history_dir, rev_name, content):
+    '''Cache a diff, counted in the ledger with the revisions of history_dir. Once the cached diffs
+    of the whole history take more than "diff_cache_max_total_size", or the history is over
+    "history_max_total_size" with them, the worker evicts some.'''
+    if settings.get('history_storage', 'copy') == 'pack':
+        record = {'name': rev_name + '.diff', 'size': len(content), 'hash': hashlib.sha1(content).hexdigest()}
+        pack = revision_pack()
+        key = history_dir_key(history_dir)
+        replaced = pack.cached_diffs(key).get(record['name'], 0)
+        stored = pack.add(key, None, record, content) - replaced
+    else:
+        path = diff_path(history_dir, rev_name)
+        make_dirs(os.path.dirname(path))
+        replaced = payload_size(path)
+        stored = write_payload(path, content) - replaced
+    if account_cached_diffs(history_dir, stored) > settings.get('diff_cache_max_total_size', 67108864):
+        history_worker.submit('evict_cached_diffs', evict_cached_diffs)
+    budget = settings.get('history_max_total_size', 0)
+    # the save that led to this diff has checked the quota already
+    if budget and history_total_size(get_history_root()) > budget:
+        history_worker.submit('enforce_quota', enforce_quota)
+
+def remove_cached_diffs(history_dir, rev_names):
+    rev_names = set(rev_names)
+    removed = 0
+    for rev_name in rev_names:
+        removed += payload_size(diff_path(history_dir, rev_name))
+        remove_payload(diff_path(history_dir, rev_name))
+    if rev_names and os.path.isdir(os.path.join(get_history_root(), PACK_DIR)):
+        key = history_dir_key(history_dir)
+        cached = revision_pack().cached_diffs(key)
+        names = [rev_name + '.diff' for rev_name in rev_names if rev_name + '.diff' in cached]
+        removed += sum(cached[name] for name in names)
+        revision_pack().drop(key, names)
+    if removed:
+        account_cached_diffs(history_dir, -removed)
+
+def cached_diffs_size(history_dir):
+    '''Bytes of the cached diffs of history_dir, in .lh_diffs and in the pack'''
+    size = 0
+    if os.path.isdir(os.path.join(history_dir, DIFF_DIR)):
+        size += sum(os.path.getsize(path) for path in scan_dir(os.path.join(history_dir, DIFF_DIR))[1])
+    if os.path.isdir(os.path.join(get_history_root(), PACK_DIR)):
+        size += sum(revision_pack().cached_diffs(history_dir_key(history_dir)).values())
+    return size
+
+def evict_cached_diffs(limit=None):
+    '''Drop the cached diffs of the least recently saved history directories until all cached diffs
+    take at most limit bytes, three quarters of "diff_cache_max_total_size" by default'''
+    if limit is None:
+        limit = settings.get('diff_cache_max_total_size', 67108864) * 3 // 4
+    history_root = get_history_root()
+    ledger = read_ledger(history_root)
+    for touched, key in sorted((max(summary['files'].values() or [0]), key) for key, summary in ledger.items()
+                               if summary.get('diffs')):
+        if cached_diffs_total(history_root) <= limit:
+            break
+        history_dir = os.path.normpath(os.path.join(history_root, key))
+        shutil.rmtree(os.path.join(history_dir, DIFF_DIR), ignore_errors=True)
+        if os.path.isdir(os.path.join(history_root, PACK_DIR)):
+            pack_key = history_dir_key(history_dir)
+            revision_pack().drop(pack_key, list(revision_pack().cached_diffs(pack_key)))
+        with ledger_lock:
+            cached = ledger_cache.get(history_root, {}).get(key, {}).get('diffs', 0)
+        account_cached_diffs(history_dir, -cached)
+
+def copy_revision_names(history_dir):
+    '''Names of the revisions stored as plain files in history_dir'''
+    names = set()
+    for path in scan_dir(history_dir)[1]:
+        name = os.path.basename(path)
+        if name.endswith(COMPRESSED_SUFFIX):
+            name = name[:-len(COMPRESSED_SUFFIX)]
+        if not name.startswith('.lh_') and not name.endswith('.tmp') and history_source_name(name) is not None:
+            names.add(name)
+    return names
+
+def rebuild_history_index(history_dir, previous=None):
+    '''Scan a history directory and write a fresh index of its revisions.
+    The records of previous, the index being replaced, are reused for the files that did not change.'''
+    index = {'version': INDEX_VERSION, 'files': {}}
+    if not os.path.isdir(history_dir):
+        return index
+
+    known = revision_map(previous) if previous else {}
+    for storage in revision_storages.values():
+        for file_name, record in storage.records(history_dir, known):
+            index['files'].setdefault(file_name, []).append(record)
+
+    for revisions in index['files'].values():
+        revisions.sort(key=lambda r: r['time'], reverse=True)
+
+    # directories on the way to other history directories do not need an index
+    if index['files'] or os.path.exists(os.path.join(history_dir, HISTORY_INDEX)):
+        write_history_index(history_dir, index)
+    return index
+
+def listed_history_index(history_dir):
+    '''Index of a history directory from the sizes and times of its revisions, without reading them.
+    Enough for the ledger, it is not written.'''
+    index = {'version': INDEX_VERSION, 'files': {}}
+    for storage in revision_storages.values():
+        for file_name, record in storage.listed(history_dir):
+            index['files'].setdefault(file_name, []).append(record)
+    for revisions in index['files'].values():
+        revisions.sort(key=lambda r: r['time'], reverse=True)
+    return index
+
+def write_history_index(history_dir, index):
+    index_path = os.path.join(history_dir, HISTORY_INDEX)
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    index_cache[history_dir] = os.path.getmtime(index_path), index
+    update_ledger(history_dir, index)
+
+def is_snapshot(rev_name):
+    return ' # ' in rev_name
+
+def summarize_index(index):
+    '''Ledger entry of a history directory: its oldest revision, the most revisions and bytes of one file,
+    the bytes it takes on disk, when each file was last saved and when the first revision was saved.
+    Snapshots are left out of the retention figures, retention never deletes them.'''
+    summary = {'oldest': None, 'count': 0, 'size': 0, 'bytes': 0, 'files': {}, 'first': None}
+    blobs = {}
+    for file_name, revisions in index['files'].items():
+        summary['files'][file_name] = revisions[0]['time']
+        if summary['first'] is None or revisions[-1]['time'] < summary['first']:
+            summary['first'] = revisions[-1]['time']
+        for r in revisions:
+            if r.get('storage') in ('blob', 'pack'):
+                blobs[r['hash']] = r.get('stored', r['size'])
+            else:
+                summary['bytes'] += r.get('stored', r['size'])
+        revisions = [r for r in revisions if not is_snapshot(r['name'])]
+        if not revisions:
+            continue
+        if summary['oldest'] is None or revisions[-1]['time'] < summary['oldest']:
+            summary['oldest'] = revisions[-1]['time']
+        summary['count'] = max(summary['count'], len(revisions))
+        summary['size'] = max(summary['size'], sum(r['size'] for r in revisions))
+    summary['bytes'] += sum(blobs.values())
+    return summary
+
+def write_ledger(history_root, ledger):
+    '''Write the whole ledger, which makes the entries logged so far redundant'''
+    make_dirs(history_root)
+    with open(os.path.join(history_root, LEDGER_FILE), 'w') as f:
+        json.dump({'version': LEDGER_VERSION, 'dirs': ledger}, f)
+    remove_payload(os.path.join(history_root, LEDGER_LOG))
+    ledger_log_lines[history_root] = 0
+
+def log_ledger(history_root, ledger, key):
+    '''Append the summary of one history directory to the ledger log, None once it is gone.
+    The log is folded into the ledger when it has grown longer than the ledger itself,
+    so a save costs one short append however many folders there are.'''
+    with open(os.path.join(history_root, LEDGER_LOG), 'a') as f:
+        f.write(json.dumps([key, ledger.get(key)]) + '\n')
+    ledger_log_lines[history_root] = ledger_log_lines.get(history_root, 0) + 1
+    if ledger_log_lines[history_root] > max(256, len(ledger)):
+        write_ledger(history_root, ledger)
+
+def load_ledger(history_root):
+    '''Ledger of history_root from memory or disk, None if it was never written. Callers hold ledger_lock.'''
+    if history_root not in ledger_cache:
+        try:
+            with open(os.path.join(history_root, LEDGER_FILE), 'r') as f:
+                ledger = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if ledger.get('version') != LEDGER_VERSION:
+            return None
+        lines = 0
+        try:
+            with open(os.path.join(history_root, LEDGER_LOG), 'r') as f:
+                for line in f:
+                    try:
+                        key, summary = json.loads(line)
+                    except ValueError:
+                        # the last entry of a write that did not complete
+                        continue
+                    if summary is None:
+                        ledger['dirs'].pop(key, None)
+                    else:
+                        ledger['dirs'][key] = summary
+                    lines += 1
+        except (IOError, OSError):
+            pass
+        ledger_cache[history_root] = ledger['dirs']
+        ledger_log_lines[history_root] = lines
+    return ledger_cache[history_root]
+
+def scan_ledger(history_root):
+    '''Summaries of all history directories, collected with one walk over their index files'''
+    ledger = {}
+    for root, dirs, files in os.walk(history_root):
+        dirs[:] = [d for d in dirs if not d.startswith('.lh_')]
+        if HISTORY_INDEX in files:
+            try:
+                with open(os.path.join(root, HISTORY_INDEX), 'r') as f:
+                    index = json.load(f)
+            except (IOError, ValueError):
+                continue
+        elif RECORD_DIR in os.listdir(root) or [f for f in files if not f.startswith('.lh_')]:
+            # revisions stored before the index existed, their index is built when the folder is next used
+            index = listed_history_index(root)
+        else:
+            continue
+        if index['files']:
+            summary = ledger[os.path.relpath(root, history_root)] = summarize_index(index)
+            summary['diffs'] = cached_diffs_size(root)
+    return ledger
+
+def read_ledger(history_root):
+    '''Copy of the ledger of history_root, scanned from the index files the first time'''
+    with ledger_lock:
+        ledger = load_ledger(history_root)
+        if ledger is not None:
+            return dict(ledger)
+
+    # scanning takes index_lock, which is held while the ledger is updated, so not under ledger_lock
+    ledger = scan_ledger(history_root)
+    with ledger_lock:
+        if load_ledger(history_root) is None:
+            ledger_cache[history_root] = ledger
+            write_ledger(history_root, ledger)
+        return dict(ledger_cache[history_root])
+
+def update_ledger(history_dir, index):
+    history_root = get_history_root()
+    key = os.path.relpath(history_dir, history_root)
+    if key.startswith(os.pardir):
+        return
+    with ledger_lock:
+        ledger = load_ledger(history_root)
+        if ledger is None:
+            return
+        old = ledger.get(key, {})
+        if index['files']:
+            ledger[key] = summarize_index(index)
+            # cached diffs are counted as they are written and removed
+            ledger[key]['diffs'] = old.get('diffs', 0)
+        elif key in ledger:
+            del ledger[key]
+        else:
+            return
+        new = ledger.get(key, {})
+        if history_root in ledger_totals:
+            ledger_totals[history_root] += summary_bytes(new) - summary_bytes(old)
+        if history_root in diff_totals:
+            diff_totals[history_root] += new.get('diffs', 0) - old.get('diffs', 0)
+        log_ledger(history_root, ledger, key)
+
+def account_cached_diffs(history_dir, change):
+    '''Add change bytes of cached diffs to the ledger entry of history_dir, returns the bytes
+    of all cached diffs of the history, 0 while there is no ledger yet'''
+    history_root = get_history_root()
+    key = os.path.relpath(history_dir, history_root)
+    with ledger_lock:
+        ledger = load_ledger(history_root)
+        # without a ledger the cached diffs on disk are counted when it is first scanned
+        if ledger is None or key not in ledger:
+            return 0
+        summary = dict(ledger[key])
+        summary['diffs'] = max(0, summary.get('diffs', 0) + change)
+        change = summary['diffs'] - ledger[key].get('diffs', 0)
+        ledger[key] = summary
+        if history_root in ledger_totals:
+            ledger_totals[history_root] += change
+        if history_root in diff_totals:
+            diff_totals[history_root] += change
+        log_ledger(history_root, ledger, key)
+    return cached_diffs_total(history_root)
+
+def summary_bytes(summary):
+    return summary.get('bytes', 0) + summary.get('diffs', 0)
+
+def history_total_size(history_root):
+    '''Bytes taken by all revisions and cached diffs under history_root, kept up to date with the ledger'''
+    with ledger_lock:
+        if history_root in ledger_totals:
+            return ledger_totals[history_root]
+    ledger = read_ledger(history_root)
+    with ledger_lock:
+        if history_root not in ledger_totals:
+            ledger_totals[history_root] = sum(summary_bytes(summary) for summary in ledger.values())
+        return ledger_totals[history_root]
+
+def cached_diffs_total(history_root):
+    '''Bytes of all cached diffs under history_root'''
+    with ledger_lock:
+        if history_root in diff_totals:
+            return diff_totals[history_root]
+    ledger = read_ledger(history_root)
+    with ledger_lock:
+        if history_root not in diff_totals:
+            diff_totals[history_root] = sum(summary.get('diffs', 0) for summary in ledger.values())
+        return diff_totals[history_root]
+
+def read_history_index(history_dir):
+    '''Revision index of a history directory, rebuilt when missing or older than the directory.
+    Callers must hold index_lock.'''
+    index_path = os.path.join(history_dir, HISTORY_INDEX)
+    index = None
+    try:
+        index_mtime = os.path.getmtime(index_path)
+        cached = index_cache.get(history_dir)
+        if cached and cached[0] == index_mtime:
+            index = cached[1]
+        else:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if index.get('version') != INDEX_VERSION:
+                index = None
+        if index is not None:
+            if index_mtime < os.path.getmtime(history_dir):
+                # in the mirror layout creating the history folder of a sub folder touches this one too,
+                # only plain revision files added or removed by something else need a rebuild
+                indexed = set(r['name'] for revisions in index['files'].values() for r in revisions
+                              if r.get('storage') is None)
+                if copy_revision_names(history_dir) != indexed:
+                    return rebuild_history_index(history_dir, index)
+                os.utime(index_path, None)
+                index_mtime = os.path.getmtime(index_path)
+            index_cache[history_dir] = index_mtime, index
+            return index
+    except (OSError, IOError, ValueError):
+        pass
+
+    return rebuild_history_index(history_dir, index)
+
+@timed_function('list')
+def get_history_revisions(file_name, history_dir):
+    '''Index records of the revisions of file_name, newest first'''
+    with index_lock:
+        revisions = read_history_index(history_dir)['files'].get(file_name, [])
+        return [dict(r) for r in revisions]
 
 def get_history_files(file_name, history_dir):
-    file_root, file_extension = os.path.splitext(file_name)
-    history_files = [os.path.join(dirpath, f)
-                        for dirpath, dirnames, files in os.walk(history_dir)
-                        for f in files if f.startswith(file_root) and f.endswith(file_extension)]
-    history_files.sort(key=lambda f: os.path.getmtime(os.path.join(history_dir, f)), reverse=True)
+    return [os.path.join(history_dir, r['name']) for r in get_history_revisions(file_name, history_dir)]
+
+def add_history_revision(history_dir, file_name, rev_name, content, digest=None):
+    '''Store content as a new revision of file_name and record it in the index.
+    The index is read before the directory changes so the write does not make it look stale.'''
+    record = {'name': rev_name, 'time': time.time(), 'size': len(content),
+              'hash': digest or hashlib.sha1(content).hexdigest()}
+    if sniff_content(content[:SNIFF_SIZE])[0] == 'binary':
+        record['binary'] = True
+    with timed('save.store') as t, index_lock:
+        index = read_history_index(history_dir)
+        drop_revisions(history_dir, index, set([rev_name]))
+        store_revision(history_dir, index, file_name, record, content)
+        index['files'].setdefault(file_name, []).insert(0, record)
+        write_history_index(history_dir, index)
+        t.bytes = record['stored']
+    if settings.get('history_search_index', True):
+        with timed('save.search'):
+            forget_search_revisions(history_dir, [rev_name])
+            index_search_revision(history_dir, file_name, record, content)
+
+def remove_history_revisions(history_dir, rev_names):
+    '''Delete revisions of history_dir and drop them from its index'''
+    rev_names = set(os.path.basename(n) for n in rev_names)
+    if not rev_names or not os.path.isdir(history_dir):
+        return
+    with index_lock:
+        index = read_history_index(history_dir)
+        drop_revisions(history_dir, index, rev_names)
+        write_history_index(history_dir, index)
+    forget_search_revisions(history_dir, rev_names)
+
+def open_revision(rev_path):
+    '''Binary file object with the content of a revision, or of any plain file'''
+    history_dir, rev_name = os.path.split(rev_path)
+    if not os.path.isfile(rev_path) and os.path.abspath(history_dir).startswith(os.path.abspath(get_history_root())):
+        with index_lock:
+            rev_map = revision_map(read_history_index(history_dir))
+            if rev_name in rev_map:
+                record = rev_map[rev_name][1]
+                return revision_storage(record).open(history_dir, rev_map, record)
+    return open_payload(rev_path)
+
+def read_revision(rev_path):
+    with open_revision(rev_path) as f:
+        return f.read()
+
+def read_revision_lines(rev_path):
+    '''Decoded lines of a revision, none for a binary one'''
+    return decode_lines(read_revision(rev_path)) or []
+
+def materialized_dir():
+    return os.path.join(tempfile.gettempdir(), 'Local History')
+
+def materialize_revision(rev_path):
+    '''Path of a plain file with the content of a revision, for views and external tools.
+    Removed by remove_materialized once no view shows it, the rest when the plugin is unloaded.'''
+    if os.path.isfile(rev_path):
+        return rev_path
+    history_dir, rev_name = os.path.split(rev_path)
+    target_dir = os.path.join(materialized_dir(), hashlib.sha1(history_dir.encode('utf-8')).hexdigest()[:12])
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    target = os.path.join(target_dir, rev_name)
+    with open_revision(rev_path) as src:
+        with open(target, 'wb') as f:
+            shutil.copyfileobj(src, f)
+    return target
+
+def is_materialized(file_path):
+    return os.path.abspath(file_path).startswith(os.path.join(materialized_dir(), ''))
+
+def remove_materialized(view):
+    '''Delete the materialized revision a closed view showed, unless another view still shows it'''
+    path = view.file_name()
+    if not path or not is_materialized(path):
+        return
+    if any(v.file_name() == path for w in sublime.windows() for v in w.views() if v.id() != view.id()):
+        return
+    remove_file(path)
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+def recorded_fingerprint(file_path):
+    '''(size, mtime, sha1) of file_path when its newest revision was recorded, or None'''
+    with fingerprint_lock:
+        fingerprint = fingerprints.pop(file_path, None)
+        if fingerprint is not None:
+            fingerprints[file_path] = fingerprint
+        return fingerprint
+
+def remember_fingerprint(file_path, size, mtime, digest):
+    with fingerprint_lock:
+        fingerprints.pop(file_path, None)
+        fingerprints[file_path] = size, mtime, digest
+        while len(fingerprints) > max(settings.get('fingerprint_cache_size', 1024), 0):
+            fingerprints.popitem(last=False)
+
+def forget_fingerprints(file_path=None):
+    '''Invalidate the cached fingerprint of file_path, or all of them'''
+    with fingerprint_lock:
+        if file_path is None:
+            fingerprints.clear()
+        else:
+            fingerprints.pop(file_path, None)
+
+def text_tokens(content):
+    '''Identifiers and words of a revision for the search index, none for binary content'''
+    lines = decode_lines(content)
+    if not lines:
+        return set()
+    return set(t.lower() for line in lines for t in TOKEN_RE.findall(line))
+
+class SearchIndex(object):
+    '''Inverted index of the revisions under a history root.
+
+    revs.log numbers revisions in the order they were indexed: "id, file key, revision path, time",
+    and "-, id" once a revision is deleted. The postings of a token are the revisions in which it
+    appeared in (+) or disappeared from (-) its file, so a save only appends the tokens it changed,
+    and a revision contains a token if the latest event of its file up to that revision is a "+".
+    Postings are spread over SEARCH_SHARDS append-only logs and read incrementally.'''
+
+    def __init__(self, history_root):
+        self.history_root = history_root
+        self.dir = os.path.join(history_root, SEARCH_DIR)
+        self.reset()
+
+    def reset(self):
+        self.revs = {}
+        self.paths = {}
+        self.file_revs = {}
+        self.dead = set()
+        self.next_id = 0
+        self.offset = 0
+        self.shards = {}
+
+    def read_log(self, path, offset):
+        '''Complete lines appended to a log since offset, and the new offset'''
+        if not os.path.exists(path):
+            return [], 0
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        data = data[:data.rfind(b'\n') + 1]
+        return data.decode('utf-8').splitlines(), offset + len(data)
+
+    def refresh(self):
+        if not os.path.exists(os.path.join(self.dir, 'revs.log')) and self.offset:
+            self.reset()
+        lines, self.offset = self.read_log(os.path.join(self.dir, 'revs.log'), self.offset)
+        for line in lines:
+            fields = line.split('\t')
+            if fields[0] == '-':
+                self.dead.add(int(fields[1]))
+                continue
+            rev_id = int(fields[0])
+            self.revs[rev_id] = fields[1], fields[2], float(fields[3])
+            self.paths[fields[2]] = rev_id
+            self.file_revs.setdefault(fields[1], []).append(rev_id)
+            self.next_id = rev_id + 1
+
+    def shard(self, token):
+        return int(hashlib.sha1(token.encode('utf-8')).hexdigest()[:4], 16) % SEARCH_SHARDS
+
+    def postings(self, token):
+        n = self.shard(token)
+        offset, events = self.shards.get(n, (0, {}))
+        lines, offset = self.read_log(os.path.join(self.dir, '%02d.log' % n), offset)
+        for line in lines:
+            t, event = line.split('\t')
+            events.setdefault(t, []).append((int(event[1:]), 1 if event[0] == '+' else -1))
+        self.shards[n] = offset, events
+        return events.get(token, [])
+
+    def tokens_path(self, key):
+        return os.path.join(self.dir, 'tokens', hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def append(self, name, lines):
+        with open(os.path.join(self.dir, name), 'ab') as f:
+            f.write(''.join(lines).encode('utf-8'))
+
+    def add(self, key, rel_path, rev_time, tokens):
+        '''Index a new revision of the file key, given all of its tokens'''
+        make_dirs(os.path.join(self.dir, 'tokens'))
+        self.refresh()
+        try:
+            with open(self.tokens_path(key), 'r') as f:
+                previous = set(f.read().split())
+        except IOError:
+            previous = set()
+
+        rev_id = self.next_id
+        shards = {}
+        for sign, changed in (('+', tokens - previous), ('-', previous - tokens)):
+            for token in changed:
+                shards.setdefault(self.shard(token), []).append('%s\t%s%d\n' % (token, sign, rev_id))
+        for n, lines in shards.items():
+            self.append('%02d.log' % n, lines)
+        with open(self.tokens_path(key), 'w') as f:
+            f.write('\n'.join(sorted(tokens)))
+        self.append('revs.log', ['%d\t%s\t%s\t%f\n' % (rev_id, key, rel_path, rev_time)])
+        self.refresh()
+
+    def remove(self, rel_paths):
+        self.refresh()
+        ids = [self.paths[p] for p in rel_paths if p in self.paths and self.paths[p] not in self.dead]
+        if ids:
+            self.append('revs.log', ['-\t%d\n' % rev_id for rev_id in ids])
+            self.refresh()
+
+    def revisions_with(self, token):
+        events = {}
+        for rev_id, sign in self.postings(token):
+            events.setdefault(self.revs[rev_id][0], []).append((rev_id, sign))
+        found = set()
+        for key, file_events in events.items():
+            file_events.sort()
+            present, i = False, 0
+            for rev_id in self.file_revs[key]:
+                while i < len(file_events) and file_events[i][0] <= rev_id:
+                    present = file_events[i][1] > 0
+                    i += 1
+                if present:
+                    found.add(rev_id)
+        return found
+
+    def search(self, query, key_prefix='', exact=False):
+        '''(revision path, time, file key) of the live revisions containing all words of query, newest first'''
+        self.refresh()
+        tokens = text_tokens(query.encode('utf-8'))
+        if not tokens:
+            return []
+        ids = None
+        for token in tokens:
+            ids = self.revisions_with(token) if ids is None else ids & self.revisions_with(token)
+            if not ids:
+                return []
+        results = []
+        for rev_id in sorted(ids - self.dead, reverse=True):
+            key, rel_path, rev_time = self.revs[rev_id]
+            if key == key_prefix or (not exact and key.startswith(key_prefix)):
+                results.append((os.path.join(self.history_root, rel_path), rev_time, key))
+        return results
+
+def search_index():
+    '''SearchIndex of the current history root, callers hold search_lock'''
+    history_root = get_history_root()
+    if history_root not in search_indexes:
+        search_indexes[history_root] = SearchIndex(history_root)
+    return search_indexes[history_root]
+
+def search_key(history_dir, file_name=''):
+    '''Key of a file, or prefix of the files of a history folder, in the search index'''
+    rel_dir = history_dir_key(history_dir).replace(os.sep, '/')
+    return rel_dir + '/' + file_name
+
+def index_search_revision(history_dir, file_name, record, content):
+    rel_path = os.path.relpath(os.path.join(history_dir, record['name']), get_history_root())
+    with search_lock:
+        search_index().add(search_key(history_dir, file_name), rel_path, record['time'], text_tokens(content))
+
+def forget_search_revisions(history_dir, rev_names):
+    history_root = get_history_root()
+    if not os.path.isdir(os.path.join(history_root, SEARCH_DIR)):
+        return
+    with search_lock:
+        search_index().remove([os.path.relpath(os.path.join(history_dir, name), history_root) for name in rev_names])
 
-    return history_files
+def rebuild_search_index():
+    '''Index all revisions of the history again, oldest first, on the worker'''
+    history_root = get_history_root()
+    with search_lock:
+        if os.path.isdir(os.path.join(history_root, SEARCH_DIR)):
+            shutil.rmtree(os.path.join(history_root, SEARCH_DIR))
+        search_index().reset()
+
+    count = 0
+    for key in sorted(read_ledger(history_root)):
+        history_dir = os.path.normpath(os.path.join(history_root, key))
+        with index_lock:
+            files = dict(read_history_index(history_dir)['files'])
+        for file_name, revisions in files.items():
+            for record in reversed(revisions):
+                index_search_revision(history_dir, file_name, record,
+                                      read_revision(os.path.join(history_dir, record['name'])))
+                count += 1
+                if count % 100 == 0:
+                    status_msg('indexing history for search, %d revisions done.' % count)
+    status_msg('search index rebuilt, %d revisions indexed.' % count)
 
 def filtered_history_files(files):
     '''Only show file name in quick panel, not path'''
@@ -68,6 +1535,59 @@ def filtered_history_files(files):
     else:
         return files
 
+def time_bucket(timestamp, now=None):
+    '''Quick panel detail line grouping revisions into today, this week and older'''
+    now = datetime.datetime.fromtimestamp(now or time.time())
+    then = datetime.datetime.fromtimestamp(timestamp)
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if then >= today:
+        return then.strftime('Today, %H:%M:%S')
+    elif then >= today - datetime.timedelta(days=6):
+        return then.strftime('This week, %A %H:%M')
+    return then.strftime('Older, %Y-%m-%d %H:%M')
+
+class HistoryPanel(object):
+    '''Quick panel over revisions, newest first, showing "quick_panel_page_size" entries at a time'''
+
+    def __init__(self, window, history_files, times, on_done):
+        self.window = window
+        self.history_files = history_files
+        self.times = times
+        self.on_done = on_done
+        self.shown = 0
+
+    def show(self, selected=0):
+        self.shown += max(settings.get('quick_panel_page_size', 100), 1)
+        now = time.time()
+        names = filtered_history_files(self.history_files[:self.shown])
+        items = [[name, time_bucket(t, now)] for name, t in zip(names, self.times)]
+        if self.shown < len(self.history_files):
+            items.append(['Load more...', '%d older revisions' % (len(self.history_files) - self.shown)])
+        if PY2:
+            self.window.show_quick_panel(items, self.on_select)
+        else:
+            self.window.show_quick_panel(items, self.on_select, 0, selected)
+
+    def on_select(self, index):
+        if index == self.shown and index < len(self.history_files):
+            sublime.set_timeout(lambda: self.show(index), 10)
+            return
+        self.on_done(index, self.history_files)
+
+def show_history_panel(window, file_name, history_dir, on_done, empty_msg, skip=0, min_count=1):
+    '''List the revisions of file_name off the UI thread and show them in a HistoryPanel.
+    on_done gets the selected index and all listed revision paths.'''
+    def list_revisions():
+        revisions = get_history_revisions(file_name, history_dir)[skip:]
+        if len(revisions) < min_count:
+            status_msg(empty_msg)
+            return
+        history_files = [os.path.join(history_dir, r['name']) for r in revisions]
+        panel = HistoryPanel(window, history_files, [r['time'] for r in revisions], on_done)
+        sublime.set_timeout(panel.show, 0)
+
+    sublime.set_timeout_async(list_revisions, 0)
+
 def check_sbs_compare():
     prefs = sublime.load_settings("Preferences.sublime-settings")
     pcsets = sublime.load_settings("Package Control.sublime-settings")
@@ -78,15 +1598,648 @@ def check_sbs_compare():
     else:
         return False
 
+class HistoryWorker(object):
+    '''One background thread running queued jobs in order.
+    Queuing a job under a key that is still pending replaces the pending one.
+    Only per-file jobs are bounded by max_pending, cleanups, migrations and restores always run.'''
+
+    def __init__(self, max_pending=1024):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.condition = Condition()
+        self.thread = None
+        self.stopping = False
+
+    def submit(self, key, func, *args):
+        self.queue(key, func, args, False)
+
+    def submit_file(self, key, func, *args):
+        '''Queue a per-file job, the oldest one is skipped once max_pending of them are waiting'''
+        self.queue(key, func, args, True)
+
+    def queue(self, key, func, args, droppable):
+        with self.condition:
+            if key in self.pending:
+                del self.pending[key]
+            elif droppable:
+                waiting = [k for k, job in self.pending.items() if job[2]]
+                if len(waiting) >= self.max_pending:
+                    del self.pending[waiting[0]]
+                    status_msg('Queue full, skipped "' + str(waiting[0]) + '".')
+            self.pending[key] = func, args, droppable
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping = False
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                func, args, droppable = self.pending.popitem(last=False)[1]
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self, timeout=None):
+        '''Let the thread finish the queued jobs and exit'''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+history_worker = HistoryWorker()
+
+def run_parallel(func, items, message=None):
+    '''Results of func for each of items, computed on "io_threads" threads for I/O bound batches.
+    message is formatted with the done and total counts for progress in the status bar.'''
+    items = list(items)
+    results = [None] * len(items)
+    jobs = iter(range(len(items)))
+    lock = Lock()
+    done = [0]
+
+    def work():
+        while True:
+            with lock:
+                i = next(jobs, None)
+            if i is None:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception:
+                traceback.print_exc()
+            with lock:
+                done[0] += 1
+                if message and done[0] % 100 == 0:
+                    status_msg(message % (done[0], len(items)))
+
+    threads = [Thread(target=work) for _ in range(max(1, min(settings.get('io_threads', 4), len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def buffer_content(view):
+    '''Text of the view encoded as it would be saved, None if that cannot be reproduced'''
+    codec = BUFFER_ENCODINGS.get(view.encoding())
+    if codec is None or view.size() > file_size_limit(view.file_name()):
+        return None
+    text = view.substr(sublime.Region(0, view.size()))
+    text = text.replace('\n', BUFFER_LINE_ENDINGS.get(view.line_endings(), '\n'))
+    try:
+        return text.encode(codec)
+    except UnicodeError:
+        return None
+
+def save_history(view):
+    '''Queue a history update, saves of the same file still waiting in the queue are merged.
+    With "history_capture": "buffer" the content is taken from the view right away,
+    so the worker does not read the file again.'''
+    file_path = view.file_name()
+    # the temporary copies revisions are opened from have no history of their own
+    if file_path and (history_filtered(file_path) or is_materialized(file_path)):
+        return
+    content = None
+    if file_path and settings.get('history_capture', 'disk') == 'buffer':
+        content = buffer_content(view)
+    history_worker.submit_file(file_path, HistorySave().process_history, file_path, content)
+
+def expired_revisions(revisions, max_age=0, max_count=0, max_size=0):
+    '''Names of the revisions of one file, newest first, that fall outside the retention policies.
+    Snapshots are kept, and so is the newest revision whatever its size.'''
+    now = time.time()
+    expired = []
+    kept_count, kept_size = 0, 0
+    for r in revisions:
+        if is_snapshot(r['name']):
+            continue
+        if ((max_age and now - r['time'] > max_age) or (max_count and kept_count >= max_count) or
+                (max_size and kept_count and kept_size + r['size'] > max_size)):
+            expired.append(r['name'])
+        else:
+            kept_count += 1
+            kept_size += r['size']
+    return expired
+
+def retention_candidates(folder, max_age=0, max_count=0, max_size=0):
+    '''History directories under folder that the ledger says hold expired revisions'''
+    history_root = get_history_root()
+    ledger = read_ledger(history_root)
+    entries = [(ledger[key]['oldest'], key, ledger[key]) for key, source in ledger_entries_under(ledger, history_dir_key(folder))]
+    entries.sort(key=lambda e: e[0])
+
+    # the ledger is ordered by the oldest revision, everything before the cutoff has expired revisions
+    aged = 0
+    if max_age:
+        aged = bisect.bisect_left([e[0] for e in entries], time.time() - max_age)
+    candidates = [key for oldest, key, summary in entries[:aged]]
+    candidates.extend(key for oldest, key, summary in entries[aged:]
+                      if (max_count and summary['count'] > max_count) or (max_size and summary['size'] > max_size))
+    return [os.path.normpath(os.path.join(history_root, key)) for key in candidates]
+
+def scan_dir(path):
+    '''Sub directories and files of path, with os.scandir where available so no entry needs another stat'''
+    dirs, files = [], []
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            (dirs if entry.is_dir(follow_symlinks=False) else files).append(entry.path)
+        return dirs, files
+    for name in os.listdir(path):
+        name = os.path.join(path, name)
+        (dirs if os.path.isdir(name) and not os.path.islink(name) else files).append(name)
+    return dirs, files
+
+def prune_history_dir(history_dir):
+    '''Remove a history directory left without revisions, and the parents that became empty with it'''
+    history_root = os.path.normpath(get_history_root())
+    history_dir = os.path.normpath(history_dir)
+    # the root also holds the ledger, search index and project snapshots
+    if history_dir == history_root:
+        return
+    with index_lock:
+        if read_history_index(history_dir)['files']:
+            return
+        for path in scan_dir(history_dir)[0]:
+            if os.path.basename(path).startswith('.lh_'):
+                shutil.rmtree(path, ignore_errors=True)
+        remove_payload(os.path.join(history_dir, HISTORY_INDEX))
+        index_cache.pop(history_dir, None)
+        forget_source(os.path.relpath(history_dir, history_root))
+        while history_dir != history_root and history_dir.startswith(history_root):
+            try:
+                os.rmdir(history_dir)
+            except OSError:
+                break
+            history_dir = os.path.dirname(history_dir)
+
+class CleanupJob(object):
+    '''A cleanup running on the worker in batches, so history saves queued meanwhile are not held back.
+    Listed in cleanup_jobs while it runs, cancel() stops it before the next batch.
+    cleanup() runs however the job ends, finished, cancelled or failed.'''
+
+    def start(self):
+        self.cancelled = False
+        cleanup_jobs.add(self)
+        history_worker.submit(self, self.next_batch)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def next_batch(self):
+        if self.cancelled:
+            self.finish(self.message.rstrip('.') + ' cancelled.')
+            return
+        try:
+            more = self.run()
+        except Exception:
+            traceback.print_exc()
+            self.finish(self.message.rstrip('.') + ' failed, see the console.')
+            return
+        if more:
+            history_worker.submit(self, self.next_batch)
+
+    def cleanup(self):
+        pass
+
+    def finish(self, message):
+        try:
+            self.cleanup()
+        finally:
+            cleanup_jobs.discard(self)
+            forget_fingerprints()
+            status_msg(message)
+
+class RetentionSweep(CleanupJob):
+    '''Deletes the expired revisions under a history folder, a batch of directories per job.
+    Directories left without revisions are pruned.'''
+    batch_size = 50
+
+    def __init__(self, folder, max_age=0, max_count=0, max_size=0, message='retention applied.'):
+        self.folder = folder
+        self.policies = {'max_age': max_age, 'max_count': max_count, 'max_size': max_size}
+        self.message = message
+        self.dirs = None
+        self.done = 0
+
+    @timed_function('retention')
+    def run(self):
+        '''Sweep one batch, True while there is more to do'''
+        if self.dirs is None:
+            self.dirs = retention_candidates(self.folder, **self.policies)
+            self.total = len(self.dirs)
+
+        batch, self.dirs = self.dirs[:self.batch_size], self.dirs[self.batch_size:]
+        for history_dir in batch:
+            if not os.path.isdir(history_dir):
+                continue
+            with index_lock:
+                index = read_history_index(history_dir)
+            expired = []
+            for revisions in index['files'].values():
+                expired.extend(expired_revisions(revisions, **self.policies))
+            remove_history_revisions(history_dir, expired)
+            prune_history_dir(history_dir)
+        self.done += len(batch)
+
+        if self.dirs:
+            status_msg('applying retention, %d of %d folders done.' % (self.done, self.total))
+            return True
+        compact_revision_pack(PACK_COMPACT_MIN)
+        self.finish(self.message)
+        return False
+
+class TreeDelete(CleanupJob):
+    '''Deletes a whole history tree: scanned with os.scandir a batch of files at a time,
+    the files removed on "io_threads" threads, then the emptied directories.'''
+    batch_size = 2000
+
+    def __init__(self, root, message):
+        self.root = root
+        self.message = message
+        self.pending = [root]
+        self.dirs = []
+        self.files = []
+        self.done = 0
+
+    @timed_function('delete')
+    def run(self):
+        while len(self.files) < self.batch_size and self.pending:
+            path = self.pending.pop()
+            self.dirs.append(path)
+            try:
+                dirs, files = scan_dir(path)
+            except OSError:
+                continue
+            self.pending.extend(dirs)
+            self.files.extend(files)
+
+        batch, self.files = self.files[:self.batch_size], self.files[self.batch_size:]
+        run_parallel(remove_file, batch)
+        self.done += len(batch)
+        if self.files or self.pending:
+            status_msg('deleting history, %d files done.' % self.done)
+            return True
+
+        for path in reversed(self.dirs):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+        self.finish(self.message)
+        return False
+
+    def cleanup(self):
+        # also after a cancel, what is left of the tree no longer matches anything kept in memory
+        reset_history_caches(self.root)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def reset_history_caches(history_root):
+    '''Forget everything kept in memory about a history that was deleted'''
+    forget_fingerprints()
+    index_cache.clear()
+    with search_lock:
+        search_indexes.pop(history_root, None)
+    with blame_lock:
+        blame_cache.clear()
+    with timeline_lock:
+        timeline_cache.clear()
+    with ledger_lock:
+        ledger_cache.pop(history_root, None)
+        ledger_totals.pop(history_root, None)
+        diff_totals.pop(history_root, None)
+    with manifest_lock:
+        manifest_cache.pop(history_root, None)
+    with pack_lock:
+        revision_packs.pop(history_root, None)
+
+def move_history_dir(history_dir, target):
+    '''Move the revisions of a history directory into target and index them there, callers hold index_lock.
+    Sub directories other than the storage ones belong to other history directories and stay.'''
+    make_dirs(target)
+    dirs, files = scan_dir(history_dir)
+    for path in files:
+        if os.path.basename(path) == HISTORY_INDEX:
+            os.remove(path)
+        else:
+            shutil.move(path, os.path.join(target, os.path.basename(path)))
+    for path in dirs:
+        if os.path.basename(path).startswith('.lh_'):
+            make_dirs(os.path.join(target, os.path.basename(path)))
+            for name in scan_dir(path)[1]:
+                shutil.move(name, os.path.join(target, os.path.basename(path), os.path.basename(name)))
+            os.rmdir(path)
+    index_cache.pop(history_dir, None)
+    index_cache.pop(target, None)
+    remove_payload(os.path.join(target, HISTORY_INDEX))
+    rebuild_history_index(target)
+
+    history_root = os.path.normpath(get_history_root())
+    while history_dir != history_root and history_dir.startswith(history_root):
+        try:
+            os.rmdir(history_dir)
+        except OSError:
+            break
+        history_dir = os.path.dirname(history_dir)
+
+def migrate_history_layout():
+    '''Move every history directory to where the "history_layout" setting puts it, on the worker.
+    The ledger is rescanned, and the search index and project snapshots follow the moved revisions.'''
+    history_root = get_history_root()
+    moved = {}
+    for n, key in enumerate(sorted(read_ledger(history_root))):
+        history_dir = os.path.normpath(os.path.join(history_root, key))
+        target = os.path.normpath(history_dir_for(history_dir_key(history_dir)))
+        if target != history_dir:
+            with index_lock:
+                move_history_dir(history_dir, target)
+            forget_source(key)
+            moved[key] = os.path.relpath(target, history_root)
+        if n % 100 == 99:
+            status_msg('migrating history, %d folders done.' % (n + 1))
+    if not moved:
+        status_msg('history already in the "%s" layout.' % settings.get('history_layout', 'mirror'))
+        return
+
+    with ledger_lock:
+        ledger_cache.pop(history_root, None)
+        ledger_totals.pop(history_root, None)
+        diff_totals.pop(history_root, None)
+        remove_payload(os.path.join(history_root, LEDGER_FILE))
+        remove_payload(os.path.join(history_root, LEDGER_LOG))
+    for manifest in project_snapshots():
+        manifest['files'] = dict((f, os.path.join(moved.get(os.path.dirname(rev), os.path.dirname(rev)),
+                                                  os.path.basename(rev)))
+                                 for f, rev in manifest['files'].items())
+        with open(project_snapshot_path(manifest['label']), 'w') as f:
+            json.dump(manifest, f)
+    reset_history_caches(history_root)
+    if settings.get('history_search_index', True):
+        rebuild_search_index()
+    status_msg('moved %d history folders to the "%s" layout.' % (len(moved), settings.get('history_layout', 'mirror')))
+
+@timed_function('save.quota')
+def enforce_quota():
+    '''Evict the oldest revisions of the least recently saved files while the history is over
+    "history_max_total_size". Snapshots and the newest revision of each file are kept.'''
+    budget = settings.get('history_max_total_size', 0)
+    history_root = get_history_root()
+    if not budget or history_total_size(history_root) <= budget:
+        return
+    # cached diffs can be computed again, they go first
+    evict_cached_diffs(max(0, cached_diffs_total(history_root) - (history_total_size(history_root) - budget)))
+    if history_total_size(history_root) <= budget:
+        return
+
+    files = sorted((touched, key, file_name) for key, summary in read_ledger(history_root).items()
+                   for file_name, touched in summary.get('files', {}).items())
+    evicted = 0
+    for touched, key, file_name in files:
+        history_dir = os.path.normpath(os.path.join(history_root, key))
+        excess = history_total_size(history_root) - budget
+        if excess <= 0:
+            break
+        revisions = [r for r in get_history_revisions(file_name, history_dir) if not is_snapshot(r['name'])][1:]
+        names = []
+        for r in reversed(revisions):
+            names.append(r['name'])
+            excess -= r.get('stored', r['size'])
+            if excess <= 0:
+                break
+        remove_history_revisions(history_dir, names)
+        evicted += len(names)
+
+    if history_total_size(history_root) > budget:
+        status_msg('history exceeds %s, only snapshots and newest revisions are left.' % readable_file_size(budget))
+    elif evicted:
+        compact_revision_pack(PACK_COMPACT_MIN)
+        forget_fingerprints()
+        status_msg('history exceeded %s, evicted %d old revisions.' % (readable_file_size(budget), evicted))
+
+def retention_policies():
+    '''Retention settings as expired_revisions arguments'''
+    return {
+        'max_age': settings.get('history_retention', 0) * 86400,
+        'max_count': settings.get('history_max_revisions', 0),
+        'max_size': settings.get('history_max_file_size', 0),
+    }
+
+def project_files(window):
+    '''Files of the project folders of window, without the excluded folders and files and the history itself'''
+    preferences = sublime.load_settings('Preferences.sublime-settings')
+    history_root = os.path.normcase(os.path.abspath(get_history_root()))
+    folders = (window.project_data() or {}).get('folders') or [{'path': f} for f in window.folders()]
+    project_dir = os.path.dirname(window.project_file_name() or '')
+    for folder in folders:
+        path = os.path.join(project_dir, os.path.expanduser(folder['path']))
+        folder_excludes = preferences.get('folder_exclude_patterns', []) + folder.get('folder_exclude_patterns', [])
+        file_excludes = preferences.get('file_exclude_patterns', []) + folder.get('file_exclude_patterns', [])
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not any(fnmatch.fnmatch(d, p) for p in folder_excludes)
+                       and os.path.normcase(os.path.abspath(os.path.join(root, d))) != history_root]
+            for name in files:
+                if not any(fnmatch.fnmatch(name, p) for p in file_excludes):
+                    yield os.path.join(root, name)
+
+def snapshot_file(file_path, label):
+    '''Snapshot a file under label, so retention and the quota keep the revision the manifest names.
+    Returns the path of that revision, relative to the history root, or None if skipped.'''
+    if history_filtered(file_path) or os.path.getsize(file_path) > file_size_limit(file_path):
+        return None
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+    file_name = os.path.basename(file_path)
+    history_dir = get_history_subdir(file_path)
+    pre, ext = os.path.splitext(file_name)
+    rev_name = pre + " # " + label + ext
+    revisions = get_history_revisions(file_name, history_dir)
+    if not [r for r in revisions if r['name'] == rev_name and r.get('hash') == digest]:
+        make_dirs(history_dir)
+        add_history_revision(history_dir, file_name, rev_name, content, digest)
+    return os.path.relpath(os.path.join(history_dir, rev_name), get_history_root())
+
+def project_snapshot_path(label):
+    return os.path.join(get_history_root(), SNAPSHOT_DIR, re.sub(r'[^\w.-]+', '_', label) + '.json')
+
+def create_project_snapshot(file_paths, label):
+    '''Snapshot all file_paths under one label and record the set in a manifest'''
+    file_paths = list(file_paths)
+    revisions = run_parallel(lambda f: snapshot_file(f, label), file_paths,
+                             'snapshot "' + label + '", %d of %d files.')
+    files = dict((f, r) for f, r in zip(file_paths, revisions) if r)
+    path = project_snapshot_path(label)
+    make_dirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump({'label': label, 'time': time.time(), 'files': files}, f)
+    status_msg('project snapshot "' + label + '" saved, %d files.' % len(files))
+
+def project_snapshots():
+    '''Manifests of the project snapshots, newest first'''
+    snapshot_dir = os.path.join(get_history_root(), SNAPSHOT_DIR)
+    manifests = []
+    for name in os.listdir(snapshot_dir) if os.path.isdir(snapshot_dir) else []:
+        try:
+            with open(os.path.join(snapshot_dir, name), 'r') as f:
+                manifests.append(json.load(f))
+        except (IOError, ValueError):
+            continue
+    return sorted(manifests, key=lambda m: m['time'], reverse=True)
+
+def restore_changes(pairs):
+    '''Diff of what restoring (revision path, file path) pairs would change, as a line stream'''
+    unchanged = missing = 0
+    for n, (rev_path, file_path) in enumerate(pairs):
+        if n % 100 == 99:
+            status_msg('comparing, %d of %d files.' % (n + 1, len(pairs)))
+        if not os.path.isfile(file_path):
+            yield "\n--- {}\n+++ {}\n\nFile no longer exists, it will be created.\n\n".format(file_path, rev_path)
+            continue
+        try:
+            diff = compute_diff(file_path, rev_path)
+        except (IOError, OSError):
+            missing += 1
+            continue
+        if diff is None:
+            unchanged += 1
+        elif isinstance(diff, types.GeneratorType):
+            for line in diff:
+                yield line
+        else:
+            yield diff
+    yield "\n{} files unchanged, {} revisions no longer in the history.\n".format(unchanged, missing)
+
+def restore_revisions(pairs):
+    '''Write the revisions of (revision path, file path) pairs over their files, returns how many files changed'''
+    def restore(pair):
+        rev_path, file_path = pair
+        try:
+            content = read_revision(rev_path)
+        except (IOError, OSError):
+            return False
+        if os.path.isfile(file_path) and os.path.getsize(file_path) == len(content):
+            with open(file_path, 'rb') as f:
+                if f.read() == content:
+                    return False
+        make_dirs(os.path.dirname(file_path))
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        forget_fingerprints(file_path)
+        return True
+
+    return sum(1 for restored in run_parallel(restore, pairs, 'restoring, %d of %d files.') if restored)
+
+def revisions_at(folder, timestamp):
+    '''(revision path, file path) of the newest revision at or before timestamp of each file under folder.
+    The ledger, ordered by first revision, rules out the directories with nothing that old,
+    the others are resolved with one index read per directory.'''
+    history_root = get_history_root()
+    ledger = read_ledger(history_root)
+    prefix = source_dir_key(folder)
+    entries = sorted((ledger[key]['first'], key, source) for key, source in ledger_entries_under(ledger, prefix))
+    entries = entries[:bisect.bisect_right([e[0] for e in entries], timestamp)]
+
+    pairs = []
+    for first, key, source in entries:
+        history_dir = os.path.normpath(os.path.join(history_root, key))
+        source_dir = os.path.normpath(os.path.join(folder, source[len(prefix):].lstrip(os.sep)))
+        with index_lock:
+            files = dict(read_history_index(history_dir)['files'])
+        for file_name, revisions in files.items():
+            # revisions are newest first
+            i = bisect.bisect_left([-r['time'] for r in revisions], -timestamp)
+            if i < len(revisions):
+                pairs.append((os.path.join(history_dir, revisions[i]['name']), os.path.join(source_dir, file_name)))
+    return sorted(pairs, key=lambda pair: pair[1])
+
+def show_restore_changes(window, pairs, on_confirm=None):
+    '''Show what restoring pairs changes in a diff view, then ask to restore them with on_confirm.
+    The whole summary is diffed on the worker, the UI thread only appends the finished text
+    and asks once all of it is shown.'''
+    def confirm():
+        if on_confirm and sublime.ok_cancel_dialog('Restore %d files as shown?' % len(pairs), 'Restore'):
+            history_worker.submit('restore', on_confirm)
+
+    def compute():
+        changes = list(restore_changes(pairs))
+
+        def show():
+            panel = window.new_file()
+            panel.set_name("## LH: Restore ##")
+            panel.set_scratch(True)
+            panel.set_syntax_file('Packages/Diff/Diff.sublime-syntax')
+            append_progressively(panel, iter(changes), on_done=confirm)
+
+        sublime.set_timeout(show, 0)
+
+    status_msg('comparing %d files...' % len(pairs))
+    history_worker.submit('restore_changes', compute)
+
+def compile_pattern(patterns):
+    '''One regex for a list of globs and "re:" prefixed regexes, None for an empty list.
+    Invalid regexes are reported and left out.'''
+    flags = re.IGNORECASE if platform.system() == 'Windows' else 0
+    regexes = []
+    for p in patterns or []:
+        regex = p[3:] if p.startswith('re:') else fnmatch.translate(p)
+        try:
+            re.compile(regex, flags)
+        except re.error as e:
+            status_msg('ignoring invalid pattern "%s": %s.' % (p, e))
+            continue
+        regexes.append(regex)
+    if not regexes:
+        return None
+    return re.compile('|'.join('(?:' + r + ')' for r in regexes), flags)
+
+def compile_filters():
+    '''Compile the file filters once per settings change, they are checked for every saved or closed view'''
+    history_filters['include'] = compile_pattern(settings.get('history_include', []))
+    history_filters['exclude'] = compile_pattern(settings.get('history_exclude', []))
+    limits = settings.get('file_size_limits', {})
+    history_filters['size_limits'] = dict(((ext if ext.startswith('.') else '.' + ext).lower(), limit)
+                                          for ext, limit in limits.items())
+
+def history_filtered(file_path):
+    '''Whether the include/exclude rules keep file_path out of the history, on the path or the file name'''
+    path = file_path.replace(os.sep, '/')
+    name = os.path.basename(file_path)
+    include, exclude = history_filters['include'], history_filters['exclude']
+    if include and not (include.match(path) or include.match(name)):
+        return True
+    return bool(exclude and (exclude.match(path) or exclude.match(name)))
+
+def file_size_limit(file_path):
+    ext = os.path.splitext(file_path)[1].lower()
+    return history_filters['size_limits'].get(ext, settings.get('file_size_limit', 4194304))
+
 def plugin_loaded():
     global settings
 
     settings = sublime.load_settings('LocalHistory.sublime-settings')
-    settings.add_on_change('reload', sublime.load_settings('LocalHistory.sublime-settings'))
+    settings.add_on_change('reload', compile_filters)
+    compile_filters()
 
     status_msg('Target directory: "' + get_history_root() + '"')
     HistoryListener.listening = False
 
+def plugin_unloaded():
+    history_worker.stop(timeout=5)
+    shutil.rmtree(materialized_dir(), ignore_errors=True)
+
 if sublime.version().startswith('2'):
     plugin_loaded()
 
@@ -138,6 +2291,29 @@ def auto_diff_pane(view, index, history_dir, history_files):
     # focus back to view
     win.focus_group(group)
 
+def open_revision_view(window, rev_path, on_open=None):
+    '''Open a revision as a scratch view, its content is materialized off the UI thread'''
+    def load():
+        path = materialize_revision(rev_path)
+
+        def show():
+            lh_view = window.open_file(path)
+            sublime.set_timeout_async(lambda: lh_view.set_scratch(True))
+            if on_open:
+                on_open(lh_view)
+
+        sublime.set_timeout(show, 0)
+
+    sublime.set_timeout_async(load, 0)
+
+def sbs_compare(view, rev_path, file_path):
+    '''Compare a revision side-by-side once it is materialized off the UI thread'''
+    def load():
+        HistorySbsCompare.vars = view, materialize_revision(rev_path), file_path
+        sublime.set_timeout(lambda: view.window().run_command("history_sbs_compare"), 0)
+
+    sublime.set_timeout_async(load, 0)
+
 def rename_tab(view, lh_view, pre, ext, snap=False):
     def delay():
         lh_file = os.path.basename(lh_view.file_name())
@@ -154,92 +2330,115 @@ class HistorySave(sublime_plugin.EventListener):
         if not PY2 or not settings.get('history_on_load', True):
             return
 
-        t = Thread(target=self.process_history, args=(view.file_name(),))
-        t.start()
+        save_history(view)
 
     def on_load_async(self, view):
         if settings.get('history_on_load', True):
-            t = Thread(target=self.process_history, args=(view.file_name(),))
-            t.start()
+            save_history(view)
 
     def on_close(self, view):
         if settings.get('history_on_close', True):
-            t = Thread(target=self.process_history, args=(view.file_name(),))
-            t.start()
+            save_history(view)
 
     def on_post_save(self, view):
         if not PY2 or settings.get('history_on_close', True):
             return
 
-        t = Thread(target=self.process_history, args=(view.file_name(),))
-        t.start()
+        save_history(view)
 
     def on_post_save_async(self, view):
         if not settings.get('history_on_close', True):
-            t = Thread(target=self.process_history, args=(view.file_name(),))
-            t.start()
+            save_history(view)
 
     def on_deactivated(self, view):
         if (view.is_dirty() and settings.get('history_on_focus_lost', False)):
-            t = Thread(target=self.process_history, args=(view.file_name(),))
-            t.start()
+            save_history(view)
 
-    def process_history(self, file_path):
+    @timed_function('save')
+    def process_history(self, file_path, content=None):
+        '''Record a new revision of file_path, its content is read from disk unless given'''
         if file_path == None:
             status_msg('File not saved, path does not exist.')
             return
 
+        if history_filtered(file_path):
+            status_msg('File not saved, excluded by "history_include"/"history_exclude".')
+            return
+
+        # with buffer capture too, views of files inside packages or deleted from disk get no history
         if not os.path.isfile(file_path):
             status_msg('File not saved, might be part of a package.')
             return
 
-        size_limit = settings.get('file_size_limit', 4194304)
-        history_retention = settings.get('history_retention', 0)
+        size_limit = file_size_limit(file_path)
         skip_recently_saved = settings.get('skip_if_saved_within_minutes')
 
         if PY2:
             file_path = file_path.encode('utf-8')
-        if os.path.getsize(file_path) > size_limit:
+        if content is None:
+            stat = os.stat(file_path)
+            size, mtime, digest = stat.st_size, stat.st_mtime, None
+        else:
+            size, mtime, digest = len(content), None, hashlib.sha1(content).hexdigest()
+        if size > size_limit:
             status_msg('File not saved, exceeded %s limit.' % readable_file_size(size_limit))
             return
 
         file_name = os.path.basename(file_path)
+
+        # unchanged since the last recorded revision, without looking at the history
+        fingerprint = recorded_fingerprint(file_path)
+        if fingerprint and (fingerprint[2] == digest if digest else fingerprint[:2] == (size, mtime)):
+            status_msg('File not saved, no changes for "' + file_name + '".')
+            return
+
         history_dir = get_history_subdir(file_path)
         if not os.path.exists(history_dir):
             os.makedirs(history_dir)
 
-        history_files = get_history_files(file_name, history_dir)
+        history_files = get_history_revisions(file_name, history_dir)
+        if content is None:
+            with timed('save.read') as t:
+                with open(file_path, 'rb') as f:
+                    content = f.read()
+                t.bytes = len(content)
+            digest = hashlib.sha1(content).hexdigest()
 
         if history_files:
-            if filecmp.cmp(file_path, os.path.join(history_dir, history_files[0])):
+            if history_files[0]['hash'] == digest:
+                remember_fingerprint(file_path, size, mtime, digest)
                 status_msg('File not saved, no changes for "' + file_name + '".')
                 return
             elif skip_recently_saved:
                 current_time = time.time()
-                last_modified = os.path.getmtime(history_files[0])
+                last_modified = history_files[0]['time']
                 if current_time - last_modified < skip_recently_saved*60:
                     status_msg('File not saved, recent backup for "' + file_name + '" exists.')
                     return
 
         file_root, file_extension = os.path.splitext(file_name)
-        shutil.copyfile(file_path, os.path.join(history_dir, '{0}-{1}{2}'.format(file_root, datetime.datetime.now().strftime(settings.get('format_timestamp', '%Y%m%d%H%M%S')), file_extension)))
+        rev_name = '{0}-{1}{2}'.format(file_root, datetime.datetime.now().strftime(settings.get('format_timestamp', '%Y%m%d%H%M%S')), file_extension)
+        add_history_revision(history_dir, file_name, rev_name, content, digest)
+        remember_fingerprint(file_path, size, mtime, digest)
+        if history_files and settings.get('diff_cache_max_size', 1048576):
+            history_worker.submit_file(('diff', history_dir, file_name), cache_incremental_diff, history_dir, file_name)
 
         status_msg('File saved, updated Local History for "' + file_name + '".')
 
-        if history_retention == 0:
+        policies = retention_policies()
+        if not any(policies.values()):
+            enforce_quota()
             return
 
-        max_valid_archive_date = datetime.date.today() - datetime.timedelta(days=history_retention)
-        for file in history_files:
-            file = os.path.join(history_dir, file)
-            if datetime.date.fromtimestamp(os.path.getmtime(file)) < max_valid_archive_date:
-                os.remove(file)
+        with timed('save.retention'):
+            expired = expired_revisions(get_history_revisions(file_name, history_dir), **policies)
+            remove_history_revisions(history_dir, expired)
+        enforce_quota()
 
 class HistorySaveNow(sublime_plugin.TextCommand):
 
     def run(self, edit):
-        t = Thread(target=HistorySave().process_history, args=(self.view.file_name(),))
-        t.start()
+        save_history(self.view)
 
 class HistoryBrowse(sublime_plugin.TextCommand):
 
@@ -267,27 +2466,21 @@ class HistoryOpen(sublime_plugin.TextCommand):
         history_dir = get_history_subdir(self.view.file_name())
         pre, ext = os.path.splitext(file_name)
 
-        history_files = get_history_files(file_name, history_dir)
-        if not history_files:
-            status_msg('Local History not found for "' + file_name + '".')
-            return
-
-        filtered_files = filtered_history_files(history_files)
-
-        def on_done(index):
+        def on_done(index, history_files):
             if index is NO_SELECTION:
                 return
 
-            lh_view = self.view.window().open_file(os.path.join(history_dir, history_files[index]))
-            sublime.set_timeout_async(lambda: lh_view.set_scratch(True))
+            on_open = None
             if settings.get('rename_tab'):
-                rename_tab(self.view, lh_view, pre, ext)
+                on_open = lambda lh_view: rename_tab(self.view, lh_view, pre, ext)
+            open_revision_view(self.view.window(), os.path.join(history_dir, history_files[index]), on_open)
 
             if settings.get('auto_diff') or autodiff:
 
                 auto_diff_pane(self.view, index, history_dir, history_files)
 
-        self.view.window().show_quick_panel(filtered_files, on_done)
+        show_history_panel(self.view.window(), file_name, history_dir, on_done,
+                           'Local History not found for "' + file_name + '".')
 
 class HistoryCompare(sublime_plugin.TextCommand):
 
@@ -300,16 +2493,7 @@ class HistoryCompare(sublime_plugin.TextCommand):
         file_name = os.path.basename(self.view.file_name())
         history_dir = get_history_subdir(self.view.file_name())
 
-        history_files = get_history_files(file_name, history_dir)
-        history_files = history_files[1:]
-
-        if history_files:
-            filtered_files = filtered_history_files(history_files)
-        else:
-            status_msg('Local History not found for "' + file_name + '".')
-            return
-
-        def on_done(index):
+        def on_done(index, history_files):
             if index is NO_SELECTION:
                 return
 
@@ -320,12 +2504,12 @@ class HistoryCompare(sublime_plugin.TextCommand):
             from_file = from_file, os.path.basename(from_file)
             to_file = self.view.file_name(), file_name
             if sbs:
-                HistorySbsCompare.vars = self.view, from_file[0], to_file[0]
-                self.view.window().run_command("history_sbs_compare")
+                sbs_compare(self.view, from_file[0], to_file[0])
             else:
                 self.view.run_command('show_diff', {'from_file': from_file, 'to_file': to_file})
 
-        self.view.window().show_quick_panel(filtered_files, on_done)
+        show_history_panel(self.view.window(), file_name, history_dir, on_done,
+                           'Local History not found for "' + file_name + '".', skip=1)
 
 class HistoryReplace(sublime_plugin.TextCommand):
 
@@ -338,16 +2522,7 @@ class HistoryReplace(sublime_plugin.TextCommand):
         file_name = os.path.basename(self.view.file_name())
         history_dir = get_history_subdir(self.view.file_name())
 
-        history_files = get_history_files(file_name, history_dir)
-        history_files = history_files[1:]
-
-        if history_files:
-            filtered_files = filtered_history_files(history_files)
-        else:
-            status_msg('Local History not found for "' + file_name + '".')
-            return
-
-        def on_done(index):
+        def on_done(index, history_files):
             if index is NO_SELECTION:
                 return
 
@@ -360,7 +2535,8 @@ class HistoryReplace(sublime_plugin.TextCommand):
             HistoryListener.listening = True
             self.view.run_command('show_diff', {'from_file': from_file, 'to_file': to_file, 'replace': True})
 
-        self.view.window().show_quick_panel(filtered_files, on_done)
+        show_history_panel(self.view.window(), file_name, history_dir, on_done,
+                           'Local History not found for "' + file_name + '".', skip=1)
 
 class HistoryIncrementalDiff(sublime_plugin.TextCommand):
 
@@ -368,14 +2544,7 @@ class HistoryIncrementalDiff(sublime_plugin.TextCommand):
         file_name = os.path.basename(self.view.file_name())
         history_dir = get_history_subdir(self.view.file_name())
 
-        history_files = get_history_files(file_name, history_dir)
-        if len(history_files) < 2:
-            status_msg('Incremental diff not found for "' + file_name + '".')
-            return
-
-        filtered_files = filtered_history_files(history_files)
-
-        def on_done(index):
+        def on_done(index, history_files):
             if index is NO_SELECTION:
                 return
 
@@ -385,49 +2554,497 @@ class HistoryIncrementalDiff(sublime_plugin.TextCommand):
 
             from_file = os.path.join(history_dir, history_files[index + 1])
             to_file = os.path.join(history_dir, history_files[index])
-            self.view.run_command('show_diff', {'from_file': from_file, 'to_file': to_file})
+            self.view.run_command('show_diff', {'from_file': from_file, 'to_file': to_file, 'incremental': True})
+
+        show_history_panel(self.view.window(), file_name, history_dir, on_done,
+                           'Incremental diff not found for "' + file_name + '".', min_count=2)
+
+def middle_snake(A, a0, a1, B, b0, b1, max_d, check):
+    '''Point (x, y) a shortest edit script of A[a0:a1] and B[b0:b1] passes through half way, found by
+    searching forward from the start and backward from the end in O(N+M) space. None after max_d
+    steps or when check() returns False, (a0, b0) if the ranges have nothing in common.'''
+    n, m = a1 - a0, b1 - b0
+    max_d = min(max_d, (n + m + 1) // 2)
+    offset = (n + m + 1) // 2 + 1
+    forward = [-1] * (2 * offset + 2)
+    backward = [-1] * (2 * offset + 2)
+    forward[offset + 1] = backward[offset + 1] = 0
+    delta = n - m
+    # odd delta: the paths meet while extending forward, even: while extending backward
+    odd = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+    for d in range(max_d + 1):
+        if not check():
+            return None
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            if k1 == -d or (k1 != d and forward[offset + k1 - 1] < forward[offset + k1 + 1]):
+                x1 = forward[offset + k1 + 1]
+            else:
+                x1 = forward[offset + k1 - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and A[a0 + x1] == B[b0 + y1]:
+                x1 += 1
+                y1 += 1
+            forward[offset + k1] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif odd:
+                k2 = offset + delta - k1
+                if 0 <= k2 < len(backward) and backward[k2] != -1 and x1 >= n - backward[k2]:
+                    return a0 + x1, b0 + y1
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            if k2 == -d or (k2 != d and backward[offset + k2 - 1] < backward[offset + k2 + 1]):
+                x2 = backward[offset + k2 + 1]
+            else:
+                x2 = backward[offset + k2 - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and A[a1 - x2 - 1] == B[b1 - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            backward[offset + k2] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not odd:
+                k1 = offset + delta - k2
+                if 0 <= k1 < len(forward) and forward[k1] != -1:
+                    x1 = forward[k1]
+                    if x1 >= n - x2:
+                        return a0 + x1, b0 + x1 - (k1 - offset)
+    if max_d < (n + m + 1) // 2:
+        return None
+    return a0, b0
+
+def myers_opcodes(a, b, max_changes=0, deadline=None, cancelled=None):
+    '''SequenceMatcher style opcodes of a shortest edit script between two lists of hashable lines,
+    computed with the linear space variant of Myers' O((N+M)D) algorithm: the middle snake splits
+    the problem in two, each solved the same way. None if more than max_changes lines differ or the
+    deadline passes or cancelled() returns True first.'''
+    def check():
+        return not ((deadline and time.time() > deadline) or (cancelled and cancelled()))
+
+    blocks = []
+    ranges = [(0, len(a), 0, len(b), max_changes // 2 + 1 if max_changes else len(a) + len(b))]
+    while ranges:
+        a0, a1, b0, b1, max_d = ranges.pop()
+        # common head and tail do not take part in the search
+        head = 0
+        while a0 + head < a1 and b0 + head < b1 and a[a0 + head] == b[b0 + head]:
+            head += 1
+        if head:
+            blocks.append((a0, b0, head))
+            a0, b0 = a0 + head, b0 + head
+        tail = 0
+        while a1 - tail > a0 and b1 - tail > b0 and a[a1 - tail - 1] == b[b1 - tail - 1]:
+            tail += 1
+        if tail:
+            blocks.append((a1 - tail, b1 - tail, tail))
+            a1, b1 = a1 - tail, b1 - tail
+        if a0 == a1 or b0 == b1:
+            continue
+        split = middle_snake(a, a0, a1, b, b0, b1, max_d, check)
+        if split is None:
+            return None
+        x, y = split
+        if (x, y) != (a0, b0) and (x, y) != (a1, b1):
+            # only the search over the whole lists is bounded by max_changes
+            ranges.append((x, a1, y, b1, len(a) + len(b)))
+            ranges.append((a0, x, b0, y, len(a) + len(b)))
+    blocks.sort()
+
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in blocks + [(len(a), len(b), 0)]:
+        if i < ai or j < bj:
+            tag = 'replace' if i < ai and j < bj else 'delete' if i < ai else 'insert'
+            opcodes.append((tag, i, ai, j, bj))
+        if size:
+            if opcodes and opcodes[-1][0] == 'equal':
+                opcodes[-1] = ('equal', opcodes[-1][1], ai + size, opcodes[-1][3], bj + size)
+            else:
+                opcodes.append(('equal', ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    return opcodes
+
+def grouped_opcodes(opcodes, n=3):
+    '''Hunks of opcodes with n lines of context, as difflib.SequenceMatcher.get_grouped_opcodes'''
+    codes = list(opcodes) or [('equal', 0, 1, 0, 1)]
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def format_range(start, stop):
+    beginning, length = start + 1, stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
+
+def unified_diff_lines(a, b, opcodes, from_name, to_name, n=3):
+    '''Unified diff of the opcodes as a stream of lines, hunk by hunk'''
+    started = False
+    for group in grouped_opcodes(opcodes, n):
+        if not started:
+            started = True
+            yield '--- {}\n'.format(from_name)
+            yield '+++ {}\n'.format(to_name)
+        first, last = group[0], group[-1]
+        yield '@@ -{} +{} @@\n'.format(format_range(first[1], last[2]), format_range(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines = [(' ', line) for line in a[i1:i2]]
+            else:
+                lines = [('-', line) for line in a[i1:i2]] + [('+', line) for line in b[j1:j2]]
+            for mark, line in lines:
+                if line.endswith('\n'):
+                    yield mark + line
+                else:
+                    yield mark + line + '\n\\ No newline at end of file\n'
+
+@timed_function('diff')
+def compute_diff(from_file, to_file, cancelled=None):
+    '''Read two revisions and diff them. Returns the diff as a line generator, None when they are equal,
+    or a summary string when they are over "diff_max_size", the diff over "diff_max_changes"/"diff_timeout"
+    or cancelled() returned True.
+    Binary revisions are compared by size and hash only.'''
+    with timed('diff.read') as t:
+        from_bytes, to_bytes = read_revision(from_file), read_revision(to_file)
+        t.bytes = len(from_bytes) + len(to_bytes)
+    f1, f2 = os.path.split(from_file)[1], os.path.split(to_file)[1]
+    from_content, to_content = decode_lines(from_bytes), decode_lines(to_bytes)
+    if from_content is None or to_content is None:
+        return None if from_bytes == to_bytes else binary_summary(f1, f2, from_bytes, to_bytes)
+
+    size = sum(len(l) for l in from_content) + sum(len(l) for l in to_content)
+    if size > settings.get('diff_max_size', 8388608):
+        return diff_summary(f1, f2, from_content, to_content, 'too large to diff')
+
+    # compare lines by small ids instead of strings
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in from_content]
+    b = [ids.setdefault(line, len(ids)) for line in to_content]
+    timeout = settings.get('diff_timeout', 3)
+    deadline = time.time() + timeout if timeout else None
+    opcodes = myers_opcodes(a, b, settings.get('diff_max_changes', 5000), deadline, cancelled)
+    if opcodes is None:
+        if deadline and time.time() > deadline:
+            return diff_summary(f1, f2, from_content, to_content, 'diff timed out after %s seconds' % timeout)
+        return diff_summary(f1, f2, from_content, to_content, 'too many changes to show')
+    if all(op[0] == 'equal' for op in opcodes):
+        return None
+    return unified_diff_lines(from_content, to_content, opcodes, from_file, to_file)
+
+@timed_function('diff.incremental')
+def incremental_diff(from_file, to_file):
+    '''compute_diff of consecutive revisions through the diff cache of their history directory.
+    Revisions never change, so a cached diff stays valid while its header names from_file.
+    Summaries are not cached, a timeout depends on how busy the machine was.'''
+    history_dir, rev_name = os.path.split(to_file)
+    header = '# ' + os.path.basename(from_file) + '\n'
+    try:
+        text = read_cached_diff(history_dir, rev_name)
+        if not PY2:
+            text = text.decode('utf-8')
+    except (IOError, OSError):
+        text = ''
+
+    if text.startswith(header):
+        text = text[len(header):]
+    else:
+        diff = compute_diff(from_file, to_file)
+        text = ''.join(diff) if isinstance(diff, types.GeneratorType) else diff or ''
+        max_size = settings.get('diff_cache_max_size', 1048576)
+        summary = diff is not None and not isinstance(diff, types.GeneratorType)
+        if max_size and len(text) <= max_size and not summary:
+            write_cached_diff(history_dir, rev_name, (header + text) if PY2 else (header + text).encode('utf-8'))
+    return (line for line in text.splitlines(True)) if text else None
+
+def cache_incremental_diff(history_dir, file_name):
+    '''Diff the two newest revisions of file_name into the cache, run on the worker after a save'''
+    revisions = get_history_revisions(file_name, history_dir)
+    if len(revisions) > 1:
+        incremental_diff(os.path.join(history_dir, revisions[1]['name']),
+                         os.path.join(history_dir, revisions[0]['name']))
+
+def timeline_page(history_dir, rev_names, pos):
+    '''Lines the timeline shows for revision pos of rev_names, newest first: its diff against the revision
+    before it, or its content for the oldest one. Kept in memory so steps back and forth are not read again.'''
+    older = rev_names[pos + 1] if pos + 1 < len(rev_names) else None
+    key = history_dir, rev_names[pos], older
+    with timeline_lock:
+        if key in timeline_cache:
+            timeline_cache[key] = timeline_cache.pop(key)
+            return timeline_cache[key]
+
+    to_file = os.path.join(history_dir, rev_names[pos])
+    if older is None:
+        content = read_revision(to_file)
+        lines = decode_lines(content) or ['\nBinary file, {} bytes.\n'.format(len(content))]
+    else:
+        lines = list(incremental_diff(os.path.join(history_dir, older), to_file) or ['\nNo differences\n'])
+    with timeline_lock:
+        timeline_cache[key] = lines
+        while len(timeline_cache) > 32:
+            timeline_cache.popitem(last=False)
+    return lines
+
+def diff_summary(f1, f2, from_content, to_content, reason):
+    return "\n--- {}\n+++ {}\n\nFiles differ, {}.\n{} lines -> {} lines\n\n\n".format(
+        f1, f2, reason, len(from_content), len(to_content))
+
+def append_progressively(view, lines, batch=2000, on_done=None):
+    '''Append the rest of a line stream to a view, one batch per UI tick, then call on_done
+    unless the view was closed meanwhile'''
+    if hasattr(view, 'is_valid') and not view.is_valid():
+        return
+    chunk = ''.join(itertools.islice(lines, batch))
+    if not chunk:
+        if on_done:
+            on_done()
+        return
+    if PY2:
+        chunk = chunk.decode('utf-8')
+    view.run_command('append', {'characters': chunk, 'force': True, 'scroll_to_end': False})
+    sublime.set_timeout(lambda: append_progressively(view, lines, batch, on_done), 1)
+
+def line_opcodes(from_lines, to_lines):
+    '''Opcodes between two line lists, everything replaced when the diff is cut off'''
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in from_lines]
+    b = [ids.setdefault(line, len(ids)) for line in to_lines]
+    timeout = settings.get('diff_timeout', 3)
+    opcodes = myers_opcodes(a, b, settings.get('diff_max_changes', 5000), time.time() + timeout if timeout else None)
+    if opcodes is None:
+        return [('replace', 0, len(a), 0, len(b))]
+    return opcodes
+
+def carry_origins(origins, opcodes, origin):
+    '''Origins of the lines on the new side of opcodes: kept from origins where equal, origin elsewhere'''
+    result = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            result.extend(origins[i1:i2])
+        else:
+            result.extend([origin] * (j2 - j1))
+    return result
+
+def revision_blame(history_dir, file_name):
+    '''Revisions of file_name oldest first, the index of the revision that introduced each line of the newest one,
+    and its lines. The origins of the newest revision are cached, so new revisions are diffed once each.'''
+    revisions = [r for r in reversed(get_history_revisions(file_name, history_dir)) if not is_snapshot(r['name'])]
+    names = [r['name'] for r in revisions]
+    key = (history_dir, file_name)
+    with blame_lock:
+        cached = blame_cache.pop(key, None)
+    if cached and cached[0] == names[:len(cached[0])]:
+        done, origins, lines = cached
+    else:
+        done, origins, lines = [], [], []
 
-        self.view.window().show_quick_panel(filtered_files, on_done)
+    for i in range(len(done), len(names)):
+        new_lines = read_revision_lines(os.path.join(history_dir, names[i]))
+        origins = carry_origins(origins, line_opcodes(lines, new_lines), i)
+        lines = new_lines
+
+    with blame_lock:
+        blame_cache[key] = names, origins, lines
+        while len(blame_cache) > 16:
+            blame_cache.popitem(last=False)
+    return revisions, origins, lines
 
 class ShowDiff(sublime_plugin.TextCommand):
 
     header = "\n-\n-    PRESS CTRL+ALT+ENTER TO ACCEPT AND REPLACE\n-\n\n"
 
-    def run(self, edit, replace=False, **kwargs):
-        from_file = kwargs['from_file'][0]
-        to_file = kwargs['to_file'][0]
+    def run(self, edit, replace=False, incremental=False, **kwargs):
+        from_file = kwargs['from_file']
+        to_file = kwargs['to_file']
+        # HistoryIncrementalDiff passes plain paths, the others (path, name) pairs
+        from_file = from_file[0] if isinstance(from_file, (list, tuple)) else from_file
+        to_file = to_file[0] if isinstance(to_file, (list, tuple)) else to_file
         if PY2:
             from_file = from_file.encode('utf-8')
-            with open(from_file, 'r') as f:
-                from_content = f.readlines()
-        else:
-            with open(from_file, 'r', encoding='utf-8') as f:
-                from_content = f.readlines()
-
-        if PY2:
             to_file = to_file.encode('utf-8')
-            with open(to_file, 'r') as f:
-                to_content = f.readlines()
-        else:
-            with open(to_file, 'r', encoding='utf-8') as f:
-                to_content = f.readlines()
 
-        diff = difflib.unified_diff(from_content, to_content, from_file, to_file)
-        diff = ''.join(diff)
-        if PY2:
-            diff = diff.decode('utf-8')
         panel = sublime.active_window().new_file()
         panel.set_name("## LH: Diff ##")
         panel.set_scratch(True)
         panel.set_syntax_file('Packages/Diff/Diff.sublime-syntax')
-        if replace and diff:
-            HistoryListener.diff_view = panel
-            panel.insert(edit, 0, self.header+diff)
-        elif diff:
-            panel.insert(edit, 0, diff)
-        else:
+        panel.insert(edit, 0, "\n  computing diff...\n")
+        panel.set_read_only(True)
+        sublime.set_timeout_async(lambda: self.compute(panel, from_file, to_file, replace, incremental), 0)
+
+    def compute(self, panel, from_file, to_file, replace, incremental):
+        '''Read and diff off the UI thread, closing the view cancels the diff'''
+        cancelled = lambda: not panel.is_valid()
+        diff = incremental_diff(from_file, to_file) if incremental else compute_diff(from_file, to_file, cancelled)
+        if cancelled():
+            return
+
+        rest = None
+        if diff is None:
             f1, f2 = os.path.split(from_file)[1], os.path.split(to_file)[1]
-            panel.insert(edit, 0, "\n--- "+f1+"\n+++ "+f2+"\n\nNo differences\n\n\n")
+            text = "\n--- "+f1+"\n+++ "+f2+"\n\nNo differences\n\n\n"
+        elif isinstance(diff, types.GeneratorType):
+            # the first screen right away, the rest while the view is already usable
+            text, rest = ''.join(itertools.islice(diff, 200)), diff
+            if PY2:
+                text = text.decode('utf-8')
+        else:
+            # a summary, replacing still works without seeing every change
+            text = diff
+        if replace and diff is not None:
+            text = self.header+text
+
+        def show():
+            if cancelled():
+                return
+            if replace and diff is not None:
+                HistoryListener.diff_view = panel
+            elif replace:
+                # nothing to replace
+                HistoryListener.listening = False
+            panel.run_command('history_render_view', {'text': text})
+            if rest:
+                sublime.set_timeout(lambda: append_progressively(panel, rest), 1)
+
+        sublime.set_timeout(show, 0)
+
+class HistoryBlame(sublime_plugin.TextCommand):
+
+    def run(self, edit):
+        if not self.view.file_name():
+            status_msg("not a valid file.")
+            return
+
+        file_name = os.path.basename(self.view.file_name())
+        history_dir = get_history_subdir(self.view.file_name())
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        sublime.set_timeout_async(lambda: self.blame(file_name, history_dir, text.splitlines(True)), 0)
+
+    def blame(self, file_name, history_dir, buffer_lines):
+        revisions, origins, lines = revision_blame(history_dir, file_name)
+        if not revisions:
+            status_msg("no history for this file.")
+            return
+
+        # lines changed since the newest revision have no origin yet
+        origins = carry_origins(origins, line_opcodes(lines, buffer_lines), None)
+        labels = [datetime.datetime.fromtimestamp(r['time']).strftime('%Y-%m-%d %H:%M:%S') for r in revisions]
+        annotated = ('{:<19} | {}'.format('not in history' if o is None else labels[o], line)
+                     for o, line in zip(origins, buffer_lines))
+
+        def show():
+            panel = self.view.window().new_file()
+            panel.set_name("## LH: Blame " + file_name + " ##")
+            panel.set_scratch(True)
+            append_progressively(panel, annotated)
+
+        sublime.set_timeout(show, 0)
+
+class HistoryTimeline(sublime_plugin.TextCommand):
+    '''One view stepping through the revisions of a file, "[" goes back and "]" forward in time'''
+
+    def run(self, edit, step=0):
+        if self.view.settings().get('lh_timeline'):
+            timeline = self.view
+        else:
+            file_path = self.view.file_name()
+            if not file_path:
+                status_msg("not a valid file.")
+                return
+            window = self.view.window()
+            timeline = next((v for v in window.views() if v.settings().get('lh_timeline') == file_path), None)
+            if timeline is None:
+                timeline = window.new_file()
+                timeline.set_name("## LH: Timeline " + os.path.basename(file_path) + " ##")
+                timeline.set_scratch(True)
+                timeline.set_read_only(True)
+                timeline.set_syntax_file('Packages/Diff/Diff.sublime-syntax')
+                timeline.settings().set('lh_timeline', file_path)
+            window.focus_view(timeline)
+
+        generation = timeline.settings().get('lh_timeline_generation', 0) + 1
+        timeline.settings().set('lh_timeline_generation', generation)
+        sublime.set_timeout_async(lambda: self.step(timeline, step, generation), 0)
+
+    def step(self, timeline, step, generation):
+        file_path = timeline.settings().get('lh_timeline')
+        history_dir = get_history_subdir(file_path)
+        revisions = get_history_revisions(os.path.basename(file_path), history_dir)
+        rev_names = [r['name'] for r in revisions]
+        if not rev_names:
+            status_msg('Local History not found for "' + os.path.basename(file_path) + '".')
+            return
+
+        # follow the shown revision by name, new saves shift the positions
+        current = timeline.settings().get('lh_timeline_revision')
+        pos = rev_names.index(current) + step if current in rev_names else 0
+        pos = max(0, min(pos, len(rev_names) - 1))
+        lines = timeline_page(history_dir, rev_names, pos)
+
+        for neighbour in (pos - 1, pos + 1):
+            if 0 <= neighbour < len(rev_names):
+                history_worker.submit_file(('timeline', history_dir, rev_names[neighbour]),
+                                           timeline_page, history_dir, rev_names, neighbour)
+
+        header = "\n-\n-    {} ({} of {}, {})\n-    [ older    ] newer\n-\n\n".format(
+            rev_names[pos], len(rev_names) - pos, len(rev_names),
+            datetime.datetime.fromtimestamp(revisions[pos]['time']).strftime('%Y-%m-%d %H:%M:%S'))
+
+        def render():
+            if not timeline.is_valid() or timeline.settings().get('lh_timeline_generation') != generation:
+                return
+            timeline.settings().set('lh_timeline_revision', rev_names[pos])
+            timeline.run_command('history_render_view', {'text': header + ''.join(lines[:200])})
+            # a later step stops the rest of this page from being appended
+            rest = itertools.takewhile(
+                lambda line: timeline.settings().get('lh_timeline_generation') == generation, lines[200:])
+            sublime.set_timeout(lambda: append_progressively(timeline, rest), 1)
+
+        sublime.set_timeout(render, 0)
+
+class HistoryRenderView(sublime_plugin.TextCommand):
+
+    def run(self, edit, text):
+        self.view.set_read_only(False)
+        self.view.replace(edit, sublime.Region(0, self.view.size()), text)
+        self.view.set_read_only(True)
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(0))
+        self.view.show(0)
+
+class HistoryPerformanceStats(sublime_plugin.WindowCommand):
+
+    def run(self, reset=False):
+        if reset:
+            with perf_lock:
+                perf_stats.clear()
+            status_msg('performance stats reset.')
+            return
+
+        panel = self.window.new_file()
+        panel.set_name("## LH: Performance Stats ##")
+        panel.set_scratch(True)
+        panel.run_command('append', {'characters': performance_report(), 'force': True})
         panel.set_read_only(True)
 
 class HistoryDeleteAll(sublime_plugin.TextCommand):
@@ -436,8 +3053,42 @@ class HistoryDeleteAll(sublime_plugin.TextCommand):
         if not sublime.ok_cancel_dialog('Are you sure you want to delete the Local History for all files?'):
             return
 
-        shutil.rmtree(get_history_root())
-        status_msg('The Local History has been deleted for all files.')
+        TreeDelete(get_history_root(), 'The Local History has been deleted for all files.').start()
+
+class HistoryMigrateLayout(sublime_plugin.ApplicationCommand):
+
+    def run(self):
+        layout = settings.get('history_layout', 'mirror')
+        if sublime.ok_cancel_dialog('Move the Local History of all files to the "' + layout + '" layout?'):
+            history_worker.submit('migrate_history_layout', migrate_history_layout)
+
+class HistoryConvertStorage(sublime_plugin.ApplicationCommand):
+
+    def run(self):
+        storage = settings.get('history_storage', 'copy')
+        if sublime.ok_cancel_dialog('Move the Local History of all files to the "' + storage + '" storage?'):
+            history_worker.submit('convert_history_storage', convert_history_storage)
+
+class HistoryCompactStorage(sublime_plugin.ApplicationCommand):
+
+    def run(self):
+        history_worker.submit('compact_revision_pack', self.compact)
+
+    def compact(self):
+        status_msg('compacted the history pack, %s reclaimed.' % readable_file_size(compact_revision_pack()))
+
+    def is_enabled(self):
+        return os.path.isdir(os.path.join(get_history_root(), PACK_DIR))
+
+class HistoryCancelCleanup(sublime_plugin.ApplicationCommand):
+
+    def run(self):
+        for job in list(cleanup_jobs):
+            job.cancel()
+        status_msg('cancelling %d running cleanups.' % len(cleanup_jobs))
+
+    def is_enabled(self):
+        return bool(cleanup_jobs)
 
 class HistoryCreateSnapshot(sublime_plugin.TextCommand):
 
@@ -461,7 +3112,10 @@ class HistoryCreateSnapshot(sublime_plugin.TextCommand):
             v = self.view
             file_name = self.pre + " # " + self.string + self.ext
             history_dir = get_history_subdir(v.file_name())
-            shutil.copyfile(v.file_name(), os.path.join(history_dir, file_name))
+            if not os.path.exists(history_dir):
+                os.makedirs(history_dir)
+            with open(v.file_name(), 'rb') as f:
+                add_history_revision(history_dir, os.path.basename(v.file_name()), file_name, f.read())
             status_msg('File snapshot saved under "' + file_name + '".')
 
 class HistoryOpenSnapshot(sublime_plugin.TextCommand):
@@ -479,8 +3133,7 @@ class HistoryOpenSnapshot(sublime_plugin.TextCommand):
             to_file = self.view.file_name(), os.path.basename(self.view.file_name())
 
             if sbs:
-                HistorySbsCompare.vars = self.view, from_file[0], to_file[0]
-                self.view.window().run_command("history_sbs_compare")
+                sbs_compare(self.view, from_file[0], to_file[0])
 
             elif replace:
                 # send vars to the listener for the diff/replace view
@@ -524,41 +3177,149 @@ class HistoryOpenSnapshot(sublime_plugin.TextCommand):
             if compare or sbs or replace:
                 Compare(index)
             elif delete:
-                os.remove(os.path.join(history_dir, history_files[index]))
+                remove_history_revisions(history_dir, [history_files[index]])
+                forget_fingerprints(self.view.file_name())
                 status_msg("The snapshot "+history_files[index]+" has been deleted.")
             else:
-                lh_view = self.view.window().open_file(os.path.join(history_dir, history_files[index]))
-                sublime.set_timeout_async(lambda: lh_view.set_scratch(True))
+                on_open = None
                 if settings.get('rename_tab'):
-                    rename_tab(self.view, lh_view, pre, ext, snap=True)
+                    on_open = lambda lh_view: rename_tab(self.view, lh_view, pre, ext, snap=True)
+                open_revision_view(self.view.window(), os.path.join(history_dir, history_files[index]), on_open)
                 if settings.get('auto_diff') or autodiff:
                     auto_diff_pane(self.view, index, history_dir, history_files)
 
         self.view.window().show_quick_panel(show_files, on_done)
 
 
+class HistoryProjectSnapshot(sublime_plugin.WindowCommand):
+
+    def run(self, action="create"):
+        if action == "create":
+            if not self.window.folders():
+                status_msg("no project folders to snapshot.")
+                return
+            self.window.show_input_panel("Enter a name for this project snapshot:  ", "", self.create, None, None)
+            return
+
+        manifests = project_snapshots()
+        if not manifests:
+            status_msg("no project snapshots found.")
+            return
+
+        items = [[m['label'], '%d files, %s' % (len(m['files']), time_bucket(m['time']))] for m in manifests]
+
+        def on_done(index):
+            if index is NO_SELECTION:
+                return
+            manifest = manifests[index]
+            history_root = get_history_root()
+            pairs = [(os.path.join(history_root, rev), f) for f, rev in sorted(manifest['files'].items())]
+            if action == "delete":
+                os.remove(project_snapshot_path(manifest['label']))
+                status_msg('project snapshot "' + manifest['label'] + '" deleted, its file snapshots are kept.')
+            elif action == "restore":
+                restore = lambda: status_msg('restored %d files from "%s".' % (restore_revisions(pairs), manifest['label']))
+                show_restore_changes(self.window, pairs, restore)
+            else:
+                show_restore_changes(self.window, pairs)
+
+        self.window.show_quick_panel(items, on_done)
+
+    def create(self, label):
+        history_worker.submit(('project_snapshot', label),
+                              lambda: create_project_snapshot(project_files(self.window), label))
+
+class HistoryRestorePoint(sublime_plugin.TextCommand):
+    '''Restore the files of the project, or of the folder of the current file, as they were at a point in time'''
+
+    formats = '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'
+
+    def run(self, edit, scope="project"):
+        if scope == "folder":
+            if not self.view.file_name():
+                status_msg("not a valid file.")
+                return
+            self.folders = [os.path.dirname(self.view.file_name())]
+        else:
+            self.folders = self.view.window().folders()
+            if not self.folders:
+                status_msg("no project folders to restore.")
+                return
+
+        now = datetime.datetime.now().strftime(self.formats[1])
+        self.view.window().show_input_panel("Restore as of (YYYY-MM-DD HH:MM):  ", now, self.on_done, None, None)
+
+    def on_done(self, string):
+        for date_format in self.formats:
+            try:
+                point = time.mktime(datetime.datetime.strptime(string.strip(), date_format).timetuple())
+                break
+            except ValueError:
+                continue
+        else:
+            status_msg('"' + string + '" is not a date.')
+            return
+
+        def resolve():
+            pairs = [pair for folder in self.folders for pair in revisions_at(folder, point)]
+            if not pairs:
+                status_msg('no revisions found before ' + string + '.')
+                return
+            restore = lambda: status_msg('restored %d files as of %s.' % (restore_revisions(pairs), string))
+            show_restore_changes(self.view.window(), pairs, restore)
+
+        sublime.set_timeout_async(resolve, 0)
+
+class HistorySearch(sublime_plugin.TextCommand):
+
+    def run(self, edit, scope="all", rebuild=False):
+        if rebuild:
+            history_worker.submit('rebuild_search_index', rebuild_search_index)
+            return
+
+        key, exact = '', False
+        if scope != "all":
+            if not self.view.file_name():
+                status_msg("not a valid file.")
+                return
+            history_dir = get_history_subdir(self.view.file_name())
+            if scope == "file":
+                key, exact = search_key(history_dir, os.path.basename(self.view.file_name())), True
+            else:
+                key = search_key(history_dir)
+
+        def on_query(query):
+            sublime.set_timeout_async(lambda: self.search(query, key, exact), 0)
+
+        self.view.window().show_input_panel("Search Local History for:", "", on_query, None, None)
+
+    def search(self, query, key, exact):
+        with search_lock:
+            results = search_index().search(query, key, exact)
+        if not results:
+            status_msg('no revisions found for "' + query + '".')
+            return
+
+        now = time.time()
+        items = [[os.path.basename(path), key + ', ' + time_bucket(t, now)] for path, t, key in results]
+
+        def on_done(index):
+            if index is NO_SELECTION:
+                return
+            open_revision_view(self.view.window(), results[index][0])
+
+        sublime.set_timeout(lambda: self.view.window().show_quick_panel(items, on_done), 0)
+
 class HistoryDelete(sublime_plugin.TextCommand):
 
     def interval(self, edit, m, mode):
 
-        choice = (
-            ["Older than one year", mode],
-            ["Older than six months", mode],
-            ["Older than one month", mode],
-            ["Older than one week", mode]
-        )
+        choice = [[caption, mode] for caption, key, seconds in RETENTION_INTERVALS]
 
         def on_done(index):
             if index is NO_SELECTION:
                 return
-            if index == 0:
-                self.run(edit, ask=False, dir=m, before_last="year")
-            elif index == 1:
-                self.run(edit, ask=False, dir=m, before_last="months6")
-            elif index == 2:
-                self.run(edit, ask=False, dir=m, before_last="month")
-            elif index == 3:
-                self.run(edit, ask=False, dir=m, before_last="week")
+            self.run(edit, ask=False, dir=m, before_last=RETENTION_INTERVALS[index][1])
 
         self.view.window().show_quick_panel(choice, on_done)
 
@@ -572,6 +3333,7 @@ class HistoryDelete(sublime_plugin.TextCommand):
             choice = (
                 ["Time interval", i1],
                 ["Time interval", i2],
+                ["Retention settings", "Age, count and size limits for all files, snapshots excluded"],
                 ["All", "All files for all folders, no exceptions"]
             )
 
@@ -584,6 +3346,9 @@ class HistoryDelete(sublime_plugin.TextCommand):
                 elif index == 1:
                     self.interval(edit, True, i2)
                 elif index == 2:
+                    RetentionSweep(get_history_root(), message='applied retention settings.',
+                                   **retention_policies()).start()
+                elif index == 3:
                     self.view.window().run_command('history_delete_all')
 
             self.view.window().show_quick_panel(choice, on_done)
@@ -591,52 +3356,10 @@ class HistoryDelete(sublime_plugin.TextCommand):
 
         # ---------------
 
-        # today
-        current = time.time()
-
         folder = get_history_subdir(self.view.file_name()) if dir else get_history_root()
-        base_name = os.path.splitext(os.path.split(self.view.file_name())[1])[0]
-
-        for root, dirs, files in os.walk(folder):
-            for f in files:
-                file = os.path.join(root, f)
-                if not os.path.isfile(file):
-                    continue
-
-                # skip snapshots
-                if re.match(base_name+" # ", f):
-                    continue
-
-                # file last modified
-                last_mod = os.path.getmtime(file)
-
-                if before_last == "year":
-                    if current - last_mod > 31536000:
-                        os.remove(file)
-
-                elif before_last == "months6":
-                    if current - last_mod > 15811200:
-                        os.remove(file)
-
-                elif before_last == "month":
-                    if current - last_mod > 2635200:
-                        os.remove(file)
-
-                elif before_last == "week":
-                    if current - last_mod > 604800:
-                        os.remove(file)
-
-        if before_last == "year":
-            status_msg('deleted files older than one year.')
-
-        elif before_last == "months6":
-            status_msg('deleted files older than six months.')
-
-        elif before_last == "month":
-            status_msg('deleted files older than one month.')
-
-        elif before_last == "week":
-            status_msg('deleted files older than one week.')
+        for caption, key, seconds in RETENTION_INTERVALS:
+            if key == before_last:
+                RetentionSweep(folder, max_age=seconds, message='deleted files ' + caption.lower() + '.').start()
 
 class HistorySbsCompare(sublime_plugin.ApplicationCommand):
 
@@ -762,15 +3485,21 @@ class HistoryReplaceDiff(sublime_plugin.TextCommand):
     def run(self, edit):
         HistoryListener.listening = False
         from_file, to_file = HistoryReplaceDiff.from_file, HistoryReplaceDiff.to_file
-        shutil.copyfile(from_file[0], to_file[0])
+        with open_revision(from_file[0]) as src:
+            with open(to_file[0], 'wb') as f:
+                shutil.copyfileobj(src, f)
+        forget_fingerprints(to_file[0])
         status_msg('"'+to_file[1]+'"'+' replaced with "' + from_file[1] + '".')
         self.view.window().run_command('close_file')
 
 
 class HistoryListener(sublime_plugin.EventListener):
     listening = False
+    diff_view = None
 
     def on_query_context(self, view, key, operator, operand, match_all):
+        if key == "history_timeline":
+            return bool(view.settings().get('lh_timeline'))
 
         if HistoryListener.listening:
             if key == "replace_diff":
@@ -782,3 +3511,4 @@ class HistoryListener(sublime_plugin.EventListener):
 
     def on_close(self, view):
         HistoryListener.listening = False
+        remove_materialized(view)
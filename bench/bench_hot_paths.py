@@ -0,0 +1,188 @@
+'''Latency and I/O of the save, list, diff and cleanup paths on a synthetic history tree.
+
+Builds a tree of many small files with many revisions each, plus a few files
+close to "file_size_limit", by saving them through HistorySave.process_history.
+Then lists, diffs and applies retention to the result and reports latency
+percentiles and the number of opens, stats and directory listings per call.
+
+    python bench/bench_hot_paths.py [--files N] [--dirs N] [--revisions N] [--large N] [--storage MODE]
+'''
+import argparse
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'stubs'))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import LocalHistory  # noqa: E402
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+
+class IOCounter(object):
+    '''Counts file opens, stats and directory listings while active'''
+    patched = (
+        (builtins, 'open', 'opens'),
+        (io, 'open', 'opens'),
+        (os, 'stat', 'stats'),
+        (os, 'listdir', 'listdirs'),
+    )
+
+    def __init__(self):
+        self.counts = dict.fromkeys(('opens', 'stats', 'listdirs'), 0)
+        self.originals = []
+
+    def wrap(self, func, name):
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return func(*args, **kwargs)
+        return counted
+
+    def __enter__(self):
+        for module, attr, name in self.patched:
+            original = getattr(module, attr)
+            self.originals.append((module, attr, original))
+            setattr(module, attr, self.wrap(original, name))
+        return self
+
+    def __exit__(self, *exc):
+        for module, attr, original in reversed(self.originals):
+            setattr(module, attr, original)
+        self.originals = []
+
+
+class Phase(object):
+    '''Latencies and I/O counts of one measured path'''
+
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+        self.io = IOCounter()
+
+    def measure(self, func, *args):
+        with self.io:
+            start = time.time()
+            result = func(*args)
+            self.times.append(time.time() - start)
+        return result
+
+    def report(self):
+        n = len(self.times) or 1
+        print('%-16s %7d %9.2f %9.2f %9.2f %9.1f %9.1f %9.1f' % (
+            self.name, len(self.times),
+            percentile(self.times, 0.5) * 1000, percentile(self.times, 0.95) * 1000, percentile(self.times, 0.99) * 1000,
+            float(self.io.counts['opens']) / n, float(self.io.counts['stats']) / n, float(self.io.counts['listdirs']) / n))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def source_text(rnd, lines):
+    return ''.join('def f%d(x):  # %s\n' % (i, 'y' * rnd.randrange(10, 60)) for i in range(lines))
+
+
+def edit(text, rnd, step):
+    lines = text.splitlines(True)
+    for _ in range(3):
+        lines[rnd.randrange(len(lines))] = 'edited(%d, %d)\n' % (step, rnd.randrange(1 << 30))
+    lines.append('appended(%d)\n' % step)
+    return ''.join(lines)
+
+
+def configure(work, storage):
+    settings = LocalHistory.settings
+    settings.set('portable', False)
+    settings.set('history_path', os.path.join(work, 'history'))
+    settings.set('history_storage', storage)
+    settings.set('format_timestamp', '%Y%m%d%H%M%S%f')
+    # diffs are cached on the worker thread after saves, measured separately below
+    settings.set('diff_cache_max_size', 0)
+    return settings
+
+
+def build_tree(work, args, save):
+    '''Source files and their history, saved through process_history one revision at a time'''
+    rnd = random.Random(1)
+    files = {}
+    for i in range(args.files):
+        path = os.path.join(work, 'src', 'pkg%d' % (i % args.dirs), 'module%d.py' % i)
+        files[path] = source_text(rnd, rnd.randrange(20, 400))
+    limit = LocalHistory.settings.get('file_size_limit', 4194304)
+    for i in range(args.large):
+        path = os.path.join(work, 'src', 'data', 'large%d.txt' % i)
+        files[path] = source_text(rnd, limit // 80)[:limit - 4096]
+
+    saver = LocalHistory.HistorySave()
+    for path in files:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+    for step in range(args.revisions):
+        for path, text in files.items():
+            text = files[path] = edit(text, rnd, step)
+            with open(path, 'w') as f:
+                f.write(text)
+            save.measure(saver.process_history, path)
+    return sorted(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--revisions', type=int, default=20)
+    parser.add_argument('--large', type=int, default=2, help='files close to file_size_limit')
+    parser.add_argument('--storage', default='copy', help='history_storage mode')
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='lh-bench-')
+    LocalHistory.plugin_loaded()
+    settings = configure(work, args.storage)
+    phases = [Phase(name) for name in ('save', 'list cold', 'list warm', 'diff', 'diff cached', 'retention')]
+    save, list_cold, list_warm, diff, diff_cached, retention = phases
+
+    try:
+        paths = build_tree(work, args, save)
+
+        for path in paths:
+            LocalHistory.index_cache.clear()
+            list_cold.measure(LocalHistory.get_history_files, os.path.basename(path), LocalHistory.get_history_subdir(path))
+        for path in paths:
+            list_warm.measure(LocalHistory.get_history_files, os.path.basename(path), LocalHistory.get_history_subdir(path))
+
+        settings.set('diff_cache_max_size', 1048576)
+        for path in paths:
+            revs = LocalHistory.get_history_files(os.path.basename(path), LocalHistory.get_history_subdir(path))
+            for newer, older in list(zip(revs, revs[1:]))[:5]:
+                diff.measure(lambda: list(LocalHistory.compute_diff(older, newer) or ()))
+                LocalHistory.incremental_diff(older, newer)
+                diff_cached.measure(lambda: list(LocalHistory.incremental_diff(older, newer) or ()))
+
+        # one pass over the whole tree, keeping half of the revisions of each file
+        LocalHistory.RetentionSweep.batch_size = len(paths) + 1
+        sweep = LocalHistory.RetentionSweep(LocalHistory.get_history_root(), max_count=max(1, args.revisions // 2))
+        retention.measure(sweep.run)
+    finally:
+        LocalHistory.history_worker.stop(timeout=5)
+        shutil.rmtree(work)
+
+    print('%d files in %d folders, %d revisions each, "%s" storage' % (len(paths), args.dirs, args.revisions, args.storage))
+    print('%-16s %7s %9s %9s %9s %9s %9s %9s' % ('path', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'opens', 'stats', 'listdirs'))
+    for phase in phases:
+        phase.report()
+
+
+if __name__ == '__main__':
+    main()
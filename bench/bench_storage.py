@@ -0,0 +1,108 @@
+'''Disk usage and open latency of the "history_storage" modes, with and without compression.
+
+Replays a series of edits of one large, frequently saved file through
+HistorySave.process_history and then reads every revision back.
+
+    python bench/bench_storage.py [--size BYTES] [--revisions N] [--chain N]
+'''
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'stubs'))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import LocalHistory  # noqa: E402
+
+
+def disk_usage(path):
+    total, count = 0, 0
+    for root, dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        count += len(files)
+    return total, count
+
+
+def edit(lines, rnd, step):
+    '''A day of log/data editing: some lines changed, a few appended'''
+    for _ in range(5):
+        lines[rnd.randrange(len(lines))] = 'edited line %d %d\n' % (step, rnd.randrange(1 << 30))
+    lines.extend('appended %d %d\n' % (step, i) for i in range(20))
+
+
+def run(storage, compression, size, revisions, chain):
+    work = tempfile.mkdtemp(prefix='lh-bench-')
+    settings = LocalHistory.settings
+    settings.set('portable', False)
+    settings.set('history_path', os.path.join(work, 'history'))
+    settings.set('history_storage', storage)
+    settings.set('history_compression', compression)
+    settings.set('delta_chain_length', chain)
+    settings.set('format_timestamp', '%Y%m%d%H%M%S%f')
+    settings.set('file_size_limit', size * 2)
+    settings.set('history_search_index', False)
+
+    rnd = random.Random(1)
+    lines = []
+    while sum(len(l) for l in lines) < size:
+        lines.append('%08d %s\n' % (len(lines), 'x' * rnd.randrange(20, 120)))
+
+    file_path = os.path.join(work, 'src', 'data.log')
+    os.makedirs(os.path.dirname(file_path))
+    saver = LocalHistory.HistorySave()
+
+    save_times = []
+    for step in range(revisions):
+        edit(lines, rnd, step)
+        with open(file_path, 'w') as f:
+            f.writelines(lines)
+        start = time.time()
+        saver.process_history(file_path)
+        save_times.append(time.time() - start)
+
+    history_dir = LocalHistory.get_history_subdir(file_path)
+    rev_paths = LocalHistory.get_history_files('data.log', history_dir)
+    open_times = []
+    for rev_path in rev_paths:
+        start = time.time()
+        LocalHistory.read_revision(rev_path)
+        open_times.append(time.time() - start)
+
+    # the pack lives at the history root, not in the history directory of the file
+    LocalHistory.history_worker.stop(timeout=5)
+    usage, files = disk_usage(LocalHistory.get_history_root())
+    shutil.rmtree(work)
+    return usage, files, len(rev_paths), save_times, open_times
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1 << 20, help='initial file size in bytes')
+    parser.add_argument('--revisions', type=int, default=50)
+    parser.add_argument('--chain', type=int, default=16, help='delta_chain_length')
+    args = parser.parse_args()
+
+    LocalHistory.plugin_loaded()
+    print('%-9s %6s %6s %12s %10s %12s %12s' % ('mode', 'revs', 'files', 'disk', 'ratio', 'save p50 ms', 'open p95 ms'))
+    baseline = None
+    for storage, compression in (('copy', False), ('dedup', False), ('delta', False), ('pack', False),
+                                 ('copy', True), ('delta', True), ('pack', True)):
+        usage, files, count, save_times, open_times = run(storage, compression, args.size, args.revisions, args.chain)
+        baseline = baseline or usage
+        print('%-9s %6d %6d %12s %9.2fx %12.2f %12.2f' % (
+            storage + ('+gz' if compression else ''), count, files, LocalHistory.readable_file_size(usage), float(baseline) / usage,
+            percentile(save_times, 0.5) * 1000, percentile(open_times, 0.95) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+'''Minimal stand-in for the sublime module so LocalHistory.py can be imported outside Sublime Text'''
+import os
+import tempfile
+
+_data_dir = tempfile.mkdtemp(prefix='lh-bench-')
+_settings = {}
+
+
+class Settings(dict):
+
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+    def add_on_change(self, key, callback):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+
+def load_settings(name):
+    return _settings.setdefault(name, Settings())
+
+
+def packages_path():
+    return os.path.join(_data_dir, 'Packages')
+
+
+def version():
+    return '3211'
+
+
+def status_message(msg):
+    pass
+
+
+def set_timeout(callback, delay=0):
+    callback()
+
+
+def set_timeout_async(callback, delay=0):
+    callback()
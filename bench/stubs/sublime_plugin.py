@@ -0,0 +1,21 @@
+'''Minimal stand-in for the sublime_plugin module'''
+
+
+class EventListener(object):
+    pass
+
+
+class TextCommand(object):
+
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand(object):
+
+    def __init__(self, window):
+        self.window = window
+
+
+class ApplicationCommand(object):
+    pass